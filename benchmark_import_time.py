@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+#coding:utf8 
+"""
+Measures the time needed to import the modules, which is the overhead paid by each MPI process at each start of 
+a simulation. Each import is measured in a fresh Python interpreter, and repeated to get the best and mean times.
+
+Usage: 
+    ./benchmark_import_time.py [repetitions] [module1 module2 ...]
+By default, the modules imported by the simulation scripts are measured, along with their heavy dependencies.
+"""
+import sys, subprocess
+import numpy as np
+
+repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+modules = sys.argv[2:] or ['numpy', 'scipy.constants', 'matplotlib.pyplot', 'meep_mpi', 
+        'meep_utils_io', 'meep_utils', 'meep_materials', 'metamaterial_models']
+
+## The code run in the fresh interpreter: reports the import time, and whether matplotlib got loaded 
+measure = "import time, sys; t0 = time.time(); import %s; print time.time()-t0, ('matplotlib' in sys.modules)"
+
+print "%-24s %10s %10s  %s" % ("module", "best [s]", "mean [s]", "loads matplotlib")
+for module in modules:
+    times = []
+    for n in range(repetitions):
+        p = subprocess.Popen([sys.executable, '-c', measure % module], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode: 
+            print "%-24s could not be imported: %s" % (module, err.strip().split('\n')[-1])
+            break
+        import_time, loads_matplotlib = out.strip().split('\n')[-1].split()
+        times.append(float(import_time))
+    else:
+        print "%-24s %10.4f %10.4f  %s" % (module, np.min(times), np.mean(times), loads_matplotlib)
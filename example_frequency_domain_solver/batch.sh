@@ -2,7 +2,7 @@
 # Note: in multiprocessing environment, run this script e.g. as `mpirun -np 2 ./batch.sh'
 
 if [ -z $NP ] ; then NP=2 ; fi			 # number of processors
-COMMAND="mpirun -np $NP ../scatter.py model=SphereWire comment=time-domain resolution=4u simtime=100p wirethick=10u cellsize=50e-6 padding=20e-6 radius=13e-6"
+COMMAND="mpirun -np $NP ../scatter.py model=SphereWire comment=time-domain resolution=4u simtime=100p wirethick=10u cellsize=50e-6 padding=20e-6 radius=13e-6 raster_cache=raster_cache"
 
 ## Generate frequency-domain results
 for ff in `seq 1000 20 1300`; do
@@ -28,4 +28,4 @@ rm -r SphereArray*frequency*/
 $COMMAND 
 #../effparam.py
 ../plot_multiline.py SphereArray_simtime=*.dat r.dat  --paramname comment
-
+rm -r raster_cache/
@@ -0,0 +1,33 @@
+#!/bin/bash
+## Benchmark of the sub-pixel averaging of materials: how accurate are the s-parameters obtained with coarse grids 
+## (with and without anti-aliasing), compared to a fine-grid reference, and how much CPU time does each run need?
+## The results are summarized in convergence.dat (columns: model, resolution, subpixel, CPU hours, RMS error of |t|)
+if [ -z $NP ] ; then NP=2 ; fi			 # number of processors
+
+declare -A models
+models[Slab]="model=Slab fillfraction=0.37 epsilon=12 simtime=100p"
+models[SphereWire]="model=SphereWire radius=33e-6 simtime=30p"
+declare -A references
+references[Slab]=1u
+references[SphereWire]=2u
+
+echo "#model resolution subpixel cpu_hours rms_error_t" > convergence.dat
+for model in Slab SphereWire; do
+	## The reference computation on a fine grid
+	ref=${references[$model]}
+	mpirun -np $NP  ../../scatter.py ${models[$model]} resolution=$ref subpixel=4
+	reffile=`cat last_simulation_name.dat`.dat
+
+	for res in 3u 4u 6u 8u; do
+		for subpixel in 1 4; do
+			start=`date +%s.%N`
+			mpirun -np $NP  ../../scatter.py ${models[$model]} resolution=$res subpixel=$subpixel
+			end=`date +%s.%N`
+			python -c "import numpy as np; import sys
+ref, dat = np.loadtxt('$reffile', unpack=True), np.loadtxt('`cat last_simulation_name.dat`.dat', unpack=True)
+err = np.sqrt(np.mean((np.interp(ref[0], dat[0], dat[3]) - ref[3])**2))
+print '$model %s %d %.5f %.5f' % ('$res', $subpixel, ($end-$start)*$NP/3600., err)" >> convergence.dat
+		done
+	done
+done
+cat convergence.dat
@@ -31,3 +31,57 @@ def harminv(x, y, d=100, f=30, amplitude_prescaling=None):
         (mf, md, mQ, mA, mp, merr) = [np.array([val]) for val in (mf, md, mQ, mA, mp, merr)]
 
     return {'frequency':mf*2, 'decay':md * 2/np.pi, 'quality':mQ, 'amplitude':mA * 2 / amplitude_prescaling, 'phase':mp, 'error':merr}
+
+## Matrix pencil method: finds the decaying oscillators in pure numpy (without the external harminv program), 
+## and allows to extrapolate the truncated time-domain records
+def matrix_pencil(y, max_modes=50, tol=1e-4):
+    """
+    Fits the uniformly sampled (real or complex) signal by a sum of decaying oscillators, y[n] = sum_m a_m z_m**n 
+    (n counted from the first sample). Only the singular values above `tol' (relative to the largest one) are kept, 
+    at most `max_modes'. Growing oscillators are omitted, so that the fit can be safely extrapolated. 
+
+    Returns the poles z, the complex amplitudes a, and the relative residual of the fit. If no oscillator can be 
+    found (all-zero record, or less than 4 samples), z and a are empty.
+    """
+    y = np.asarray(y, dtype=complex)
+    L = min(len(y)//2, 4*max_modes)                 ## pencil parameter (kept small for speed)
+    if L < 2 or not np.any(y):
+        return np.zeros(0, dtype=complex), np.zeros(0, dtype=complex), (1. if np.any(y) else 0.)
+    hankel = np.array([y[i:i+L+1] for i in range(len(y)-L)])
+    s, Vh = np.linalg.svd(hankel, full_matrices=False)[1:]
+    M = min(max_modes, np.sum(s > s[0]*tol))
+    V1, V2 = Vh[:M, :-1].T, Vh[:M, 1:].T
+    z = np.linalg.eigvals(np.dot(np.linalg.pinv(V1), V2))
+    z = z[np.abs(z) <= 1.]
+    Z = z[np.newaxis,:] ** np.arange(len(y))[:,np.newaxis]
+    a = np.linalg.lstsq(Z, y, rcond=None)[0]
+    residual = np.linalg.norm(y - np.dot(Z, a)) / max(np.linalg.norm(y), 1e-300)
+    return z, a, residual
+
+def harminv_numpy(t, y, max_modes=50, tol=1e-4):
+    """ The oscillators found by matrix_pencil(), in a dict similar to the one returned by harminv(): 
+    frequency [Hz], decay rate of the amplitude [1/s], quality factor, amplitude and phase, and the relative 
+    residual of the whole fit as 'error' """
+    z, a, residual = matrix_pencil(y, max_modes, tol)
+    dt = t[1]-t[0]
+    frequency, decay = np.angle(z)/(2*np.pi*dt), -np.log(np.abs(z))/dt
+    return {'frequency':frequency, 'decay':decay, 'quality':np.pi*np.abs(frequency)/np.maximum(decay, 1e-300), 
+            'amplitude':np.abs(a), 'phase':np.angle(a), 'error':residual*np.ones_like(frequency)}
+
+def harminv_extrapolate(t, y, t_end, fit_tail=.5, max_modes=50, tol=1e-4):
+    """
+    Prolongs the time-domain record up to `t_end', using the decaying oscillators fitted to its last part 
+    (`fit_tail' of the record, which should contain no source any more). 
+    Returns the new time axis, the extended signal, and the relative residual of the fit (if it is not small, 
+    the extrapolated spectrum should not be trusted). If no oscillators were found (see matrix_pencil()), the 
+    record is returned as is, without extrapolation.
+    """
+    start = int(len(t)*(1-fit_tail))
+    z, a, residual = matrix_pencil(y[start:], max_modes, tol)
+    if not len(z):
+        return t, y, residual
+    dt = t[1]-t[0]
+    n = np.arange(len(t)-start, len(t)-start+max(int(round((t_end-t[-1])/dt)), 0))
+    y_new = np.dot(z[np.newaxis,:] ** n[:,np.newaxis], a)
+    if not np.iscomplexobj(y): y_new = np.real(y_new)
+    return np.append(t, t[-1] + dt*(n-n[0]+1) if len(n) else []), np.append(y, y_new), residual
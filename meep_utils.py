@@ -22,17 +22,18 @@ TODOs optional:
       ...   matplotlib.use('Agg') ## Enable plotting even in the GNU screen session
 """
 import os, os.path, sys, subprocess, time
+from contextlib import closing
 import numpy as np
 from scipy.constants import c, epsilon_0, mu_0
 
-import matplotlib
-matplotlib.use('Agg') # may help against the "tkinter.TclError: bad screen distance" error
-import matplotlib.pyplot as plt
+## Note: matplotlib is imported only when plotting, see the meep_utils_plot module
 
 import meep_mpi as meep
 import _meep_mpi as _meep
 #import meep
 
+from meep_utils_io import savetxt, loadtxt_params, loadtxt_columns, WaveformStream, load_waveform
+
 ## === User interaction and convenience routines ===
 def phys_to_float(s):#{{{
     """
@@ -60,6 +61,16 @@ def phys_to_float(s):#{{{
     except IndexError:
         raise ValueError("Empty string was provided as a parameter")
     #}}}
+## Command-line parameters that only control how the simulation runs, without affecting its results. They are stored 
+## as attributes of the model, but they are not added to the simulation name nor to the exported parameters.
+run_control_params = ('raster_cache', 'running_dft', 'resume')
+## Parameters not defined by the models, but used by the simulation scripts and by the routines in this module
+script_params = ('Kx', 'Ky', 'Kz', 'model', 'frequency', 'MaxTol', 'MaxIter', 'BiCGStab', 'subpixel', 'decay_dB', 'extrapolate', 
+        'instability_dB')
+## Parameters that do not change the geometry, i.e. runs differing in them may share the cached material raster
+nongeometric_params = tuple([param for param in script_params if param != 'subpixel']) + \
+        ('simtime', 'loss', 'epsilon', 'eps2', 'diel', 'comment')
+
 def process_param(args):#{{{                  %% TODO include this code into Abstr..Model.init()
     """ Parse command-line parameters and store them as attributes of the model """
     model_param = {}
@@ -84,6 +95,117 @@ class Timer():#{{{
             meep.master_printf("Progress %.2f of expected total %d s\n" % \
                     (now / self.simtime, (self.simtime / now * self.get_time())))
             self.reporttimes[0:1] = []
+    def next_report(self):
+        """ The time after which print_progress() prints the next message """
+        return self.reporttimes[0] * self.simtime
+#}}}
+def source_width(model):#{{{
+    """ Returns the frequency width of the gaussian source of the model, or None if the model defines none 
+    (some older scripts name it `srcWidth') """
+    return getattr(model, 'src_width', None) or getattr(model, 'srcWidth', None)
+#}}}
+class DecayStopCriterion():#{{{
+    """
+    Allows to end the time-domain simulation before `simtime', once the field energy seen by the monitors has 
+    decayed by `decay_dB' below its peak. 
+
+    The energy is estimated from the last samples of the monitors, so no additional fields are retrieved from MEEP 
+    (and all processes get the same values, so that they stop at the same time step). To avoid stopping at a node of 
+    the oscillating field, the maximum energy in each `window' is compared. The decay is tested only after 
+    `source_end' (by default, the end of the gaussian source at 10/src_width). If the model has no source width,
+    the defaults are 10% of `simtime' for `source_end' and 2% of `simtime' for the `window'.
+
+    Once the decay is detected at time t, the simulation continues until t/0.8 (or `simtime'), so that the last 20% 
+    of the record are faded out by the Hann window as in get_s_parameters(); the monitors with running Fourier 
+    transform apply the same fadeout (their `simtime' is set to the new end). Their spectra are thus equal to 
+    those computed from the recorded waveforms.
+    """
+    def __init__(self, model, monitors, decay_dB, source_end=None, window=None):
+        self.monitors = list(monitors)
+        self.simtime = model.simtime
+        self.decay_dB = decay_dB
+        self.threshold = 10**(-decay_dB/10.)
+        width = source_width(model)
+        self.source_end = source_end if source_end is not None else (10./width if width else .1*model.simtime)
+        self.window = window if window is not None else (2./width if width else .02*model.simtime)
+        self.peak, self.window_max, self.window_start = 0., 0., 0.
+        self.stop_time = None
+        self.fadeout_end = None
+
+    def should_stop(self, now):
+        if self.fadeout_end is not None:
+            if now < self.fadeout_end: 
+                return False
+            self.stop_time = now
+            meep.master_printf("Field energy decayed by %.1f dB, ending the simulation at %e s\n" % (self.decay_dB, now))
+            return True
+        energy = sum([np.sum(np.abs(monitor.last_value)**2) for monitor in self.monitors if monitor.last_value is not None])
+        self.peak = max(self.peak, energy)
+        self.window_max = max(self.window_max, energy)
+        if now - self.window_start < self.window: 
+            return False
+        decayed = (self.window_start > self.source_end) and (self.window_max < self.peak * self.threshold)
+        self.window_start, self.window_max = now, 0.
+        if decayed and now/.8 < self.simtime: 
+            self.fadeout_end = now/.8
+            for monitor in self.monitors:       ## (the running Fourier transform is to be faded out before the new end)
+                if getattr(monitor, 'dft_freq', None) is not None: monitor.simtime = self.fadeout_end
+        return False
+#}}}
+class InstabilityWatchdog():#{{{
+    """
+    Aborts the time-domain simulation when the fields become numerically unstable, which typically happens if some 
+    dispersive material breaks the FDTD stability criteria (see AbstractMeepModel.test_materials()). Otherwise the 
+    simulation would compute NaNs or exponentially growing fields until `simtime'.
+
+    As in DecayStopCriterion, only the last samples of the monitors are checked. The fields are considered 
+    unstable if the samples are not finite, or if after `source_end' the energy exceeds by `growth_dB' the 
+    highest energy seen until the end of the source (no passive structure can do this). If the model has no source 
+    width, the source is assumed to end at 10% of `simtime'.
+    """
+    def __init__(self, model, monitors, growth_dB=40., source_end=None):
+        self.model = model
+        self.monitors = list(monitors)
+        self.growth_dB = growth_dB
+        self.threshold = 10**(growth_dB/10.)
+        width = source_width(model)
+        self.source_end = source_end if source_end is not None else (10./width if width else .1*model.simtime)
+        self.peak = 0.
+        self.unstable = False
+
+    def should_stop(self, now):
+        energy = sum([np.sum(np.abs(monitor.last_value)**2) for monitor in self.monitors if monitor.last_value is not None])
+        if not np.isfinite(energy): 
+            reason = "the monitored field is not finite"
+        elif now > self.source_end and self.peak > 0 and energy > self.peak * self.threshold: 
+            reason = "the monitored energy grew by more than %.0f dB after the source ended" % self.growth_dB
+        else:
+            if now <= self.source_end: self.peak = max(self.peak, energy)
+            return False
+        self.unstable = True
+        meep.master_printf("Error: numerical instability at %e s, %s\n" % (now, reason))
+        self.report_suspects()
+        return True
+
+    def report_suspects(self):
+        """ Names the material and the oscillator that most likely caused the instability """
+        f_c = self.model.f_c()
+        eps_minimum = meep.use_Courant()**2 * 3
+        suspects = []
+        for material in getattr(self.model, 'materials', []):
+            margin = analytic_eps(material, f_c).real - eps_minimum
+            for n, osc in enumerate(material.pol):
+                omega_0, gamma = osc['omega'], osc['gamma']   ## (non-angular!) frequency of the oscillator and damping rate
+                if (omega_0 > gamma/2): z = np.sqrt(gamma*gamma + 4*omega_0*omega_0)/2
+                else:                   z = gamma/2 + np.sqrt(gamma*gamma - 4*omega_0*omega_0)/2
+                suspects.append((margin, -z, material.name, n))
+        if not suspects:
+            meep.master_printf("\tNo dispersive material is defined; check the permittivities, the Courant factor and the PML\n")
+            return
+        (margin, z, name, n) = min(suspects)     ## the lowest stability margin, and the fastest pole of the material
+        meep.master_printf("\tSuspect: oscillator %d of material `%s' (its pole at %.3f f_c, eps'(f_c) is %.2f above the stability limit)\n" % 
+                (n, name, -z/f_c, margin))
+        meep.master_printf("\tIt may help to run fix_material_stability() for this material, or to use finer resolution.\n")
 #}}}
 def notify(title, run_time=None):#{{{
     """
@@ -139,10 +261,18 @@ class AbstractMeepModel(meep.Callback):
         meep.Callback.__init__(self)
         self.double_vec = None          # (callback function to be redirected to the desired function)
         self.return_value = True  
+        self.material_raster = None     # (filled by build_material_raster(), if the materials allow it)
+        self.registered_params = {}     # (filled by register_local())
+        self.symmetry_planes = ()       # (mirror planes through the cell center that the model may declare, see check_symmetry())
+        self.mirrors = []               # (the mirror symmetries actually used, set by init_structure())
+        self.nongeometric_params = nongeometric_params     # (a model may extend it, see raster_cache_key())
         #}}}
     def get_static_permittivity(self, r):#{{{
         """ Scans through materials and returns the high-frequency part of permittivity for the first in the list. 
         Be careful when materials overlap - their polarizabilities still sum up, making a nonrealistic result. 
+
+        The rasterized materials (see build_material_raster()) are summed in advance, so that they cost one lookup only.
+        The other ones are memoized by get_material_weight(), to be reused when their polarizabilities are built.
         """
         ## TODO #CSGspeedup rewrite to:  sum([mat.eps for mat in self.materials if mat.where(r)]) or 1 
         ## TODO rewrite the geometric functions to lambdas and test the speed!
@@ -150,12 +280,166 @@ class AbstractMeepModel(meep.Callback):
             #if mat.where(r): return mat.eps         ## TODO: #realCproject will MEEP use the natural speed of light 3e8 m/s, if this is multiplied by eps0?
             #else: return 1.                             ## TODO: and here too   (... this also needs that similar approach is used to define mu=mu0 everywhere)
 
-        sum_permittivity = 1        # start with relative permittivity vacuum 
-        for mat in self.materials:
-            #materialhere = mat.where(r)
-            #if materialhere > 0: 
-            sum_permittivity += (mat.eps-1)*mat.where(r)
-        return sum_permittivity      # materials can be blended, but if none present, assume vacuum
+        if self.material_raster is None:
+            sum_permittivity = 1        # start with relative permittivity vacuum
+            for mat in self.materials:
+                sum_permittivity += (mat.eps-1)*mat.where(r)
+            return sum_permittivity      # materials can be blended, but if none present, assume vacuum
+
+        sum_permittivity = float(self.static_permittivity_raster[self.raster_index(r)])
+        for n, (mat, raster) in enumerate(zip(self.materials, self.material_raster)):
+            if raster is None:
+                sum_permittivity += (mat.eps-1)*self.get_material_weight(n, r)
+        return sum_permittivity
+        #}}}
+    def build_material_raster(self, cache_dir=None):#{{{
+        """ Evaluates the materials once over the whole Yee lattice, using NumPy instead of the per-voxel callbacks.
+
+        A material may provide an optional function `where_array(x, y, z)'; it receives the coordinate arrays (that are
+        broadcastable against each other) and returns the material presence between 0 and 1 for each point. Unlike
+        `where()', it shall not multiply the result by `self.return_value'.
+
+        The raster has the step of half a voxel, so that it contains all points where MEEP samples the material
+        functions. The callbacks then become simple index lookups. Materials without `where_array' are left to their
+        `where()' callback, so both approaches can be combined in one model.
+
+        If `cache_dir' is given, the raster is stored there and reused by later runs with the same geometry (see 
+        raster_cache_key()). 
+
+        If the model has a parameter `subpixel' (e.g. given on the command line), each raster point is averaged from 
+        `subpixel' points along each axis. The material boundaries are then anti-aliased, i.e. the permittivity and 
+        the oscillator weights follow the volume fraction of the material, which allows for a coarser grid.
+        """
+        self.raster_axes = [yee_lattice_axis(self.size_x, self.resolution), yee_lattice_axis(self.size_y, self.resolution),
+                yee_lattice_axis(self.size_z, self.resolution) if self.size_z else np.array([0.])]
+        shape = tuple(len(axis) for axis in self.raster_axes)
+
+        cache_file = os.path.join(cache_dir, "raster_%s.npz" % self.raster_cache_key()) if cache_dir else None
+        if cache_file and os.path.isfile(cache_file):
+            with closing(np.load(cache_file)) as cached:
+                self.material_raster = [cached['material%d' % n] if ('material%d' % n) in cached.files else None
+                        for n in range(len(self.materials))]
+            meep.master_printf("Info\tLoaded the material raster from %s\n" % cache_file)
+        else:
+            self.material_raster = []
+            for mat in self.materials:
+                where_array = get_where_array(mat)
+                if where_array is None:
+                    self.material_raster.append(None)
+                    continue
+                self.material_raster.append(rasterize(where_array, self.raster_axes, self.resolution, 
+                    subpixel=int(getattr(self, 'subpixel', 1))))
+            if cache_file and meep.my_rank() == 0: 
+                save_raster_cache(cache_file, self.material_raster)
+
+        self.static_permittivity_raster = np.ones(shape, dtype=np.float32)
+        self.material_memo = [None] * len(self.materials)   ## (allocated at the first where() call, see get_material_weight())
+        for mat, raster in zip(self.materials, self.material_raster):
+            if raster is not None:
+                self.static_permittivity_raster += (mat.eps-1)*raster
+        meep.master_printf("Info\tRasterized %d of %d materials on a lattice of %dx%dx%d points\n" %
+                ((len([r for r in self.material_raster if r is not None]), len(self.materials)) + shape))
+        if int(getattr(self, 'subpixel', 1)) > 1:
+            for mat, raster in zip(self.materials, self.material_raster):
+                if raster is None:
+                    meep.master_printf("Warning\tMaterial %s has no where_array(), it gets no sub-pixel averaging\n" % 
+                            mat.name)
+        #}}}
+    def raster_cache_key(self):#{{{
+        """ Returns a hash of everything the material raster depends on: the model class, the grid, the parameters 
+        that are not listed in `self.nongeometric_params', and the names of materials (in their order). 
+
+        The source code of the module defining the model, and of this module (with the geometry and the rasterization)
+        is hashed as well, so that any change of the `where' functions invalidates the cached rasters. """
+        import hashlib, inspect
+        sources = []
+        for module in (sys.modules[self.__class__.__module__], sys.modules[__name__]):
+            try:
+                with open(inspect.getsourcefile(module)) as sourcefile: sources.append(sourcefile.read())
+            except (IOError, TypeError):            ## (e.g. a model defined interactively)
+                sources.append(None)
+        params = [(k, v) for (k, v) in sorted(self.registered_params.items()) if k not in self.nongeometric_params]
+        key = repr((raster_cache_version, self.__class__.__name__, repr(self.resolution), repr(self.size_x), repr(self.size_y), 
+                repr(self.size_z), [(k, repr(v)) for (k, v) in params], [mat.name for mat in self.materials], 
+                [hashlib.md5(source).hexdigest() if source else None for source in sources]))
+        return hashlib.md5(key).hexdigest()
+        #}}}
+    def raster_index(self, r, exact=False):#{{{
+        """ Returns the index of the nearest point of the material raster to the meep.vec `r'. 
+        If `exact', returns None unless `r' lies on the raster (i.e. on the Yee lattice of the simulation). """
+        index = []
+        for coord, axis in zip((r.x(), r.y(), r.z()), self.raster_axes):
+            i = int(round((coord-axis[0]) * 2 / self.resolution))
+            if exact and (i < 0 or i >= len(axis) or abs(coord-axis[i]) > self.resolution/8):
+                return None
+            index.append(0 if i < 0 else (len(axis)-1 if i >= len(axis) else i))
+        return tuple(index)
+        #}}}
+    def check_symmetry(self, planes):#{{{
+        """ Returns those of the mirror `planes' (meep.X, meep.Y or meep.Z, i.e. the normals of the planes going 
+        through the center of the cell) to which all the materials are symmetric.
+
+        The rasterized materials (see build_material_raster()) are compared with their mirror image on the whole
+        Yee lattice; the other ones are evaluated by their `where()' callback on a coarse grid only. """
+        axis_index = {meep.X:0, meep.Y:1, meep.Z:2}
+        coarse_axes = [np.linspace(-.493, .493, 15)*size if size else np.array([0.]) for size in (self.size_x, self.size_y, self.size_z)]
+        symmetric_planes = []
+        for plane in planes:
+            flip = [slice(None)]*3
+            flip[axis_index[plane]] = slice(None, None, -1)
+            for n, material in enumerate(self.materials):
+                raster = self.material_raster[n] if self.material_raster else None
+                if raster is None:
+                    shape = tuple(len(axis) for axis in coarse_axes)
+                    raster = np.zeros(shape)
+                    return_value, self.return_value = self.return_value, 1
+                    for i, j, k in np.ndindex(shape):
+                        raster[i,j,k] = material.where(meep.vec(coarse_axes[0][i], coarse_axes[1][j], coarse_axes[2][k]))
+                    self.return_value = return_value
+                if not np.allclose(raster, raster[tuple(flip)], atol=1e-6):
+                    meep.master_printf("Info\tMaterial %s is not symmetric to the mirror plane %s, the symmetry is not used\n" % 
+                            (material.name, 'XYZ'[axis_index[plane]]))
+                    break
+            else:
+                symmetric_planes.append(plane)
+        return symmetric_planes
+        #}}}
+    def get_material_weight(self, n, r):#{{{
+        """ Returns the presence of the n-th material at `r', i.e. its `where(r)' for return_value equal to one. 
+
+        Rasterized materials are only looked up. For the other ones, `where()' is called only once per lattice point 
+        and the result is memoized, so that it is reused by all oscillators of the material. This assumes the 
+        `where()' result is proportional to `self.return_value', as in all models defined in the usual way.  """
+        if self.material_raster[n] is not None:
+            return float(self.material_raster[n][self.raster_index(r)])
+        index = self.raster_index(r, exact=True)
+        if index is not None:
+            if self.material_memo[n] is None:
+                self.material_memo[n] = np.empty(tuple(len(axis) for axis in self.raster_axes), dtype=np.float32)
+                self.material_memo[n].fill(np.nan)      ## (NaN marks the points not evaluated yet)
+            weight = self.material_memo[n][index]
+            if weight == weight:            ## (not NaN, i.e. already evaluated)
+                return float(weight)
+        return_value, self.return_value = self.return_value, 1
+        try:
+            weight = float(self.materials[n].where(r))
+        finally:
+            self.return_value = return_value
+        if index is not None:
+            self.material_memo[n][index] = weight
+        return weight
+        #}}}
+    def where_geometry(self, geometry):#{{{
+        """ Turns a Geometry object into the `where' function of a material. The returned function respects 
+        `self.return_value' and carries also the vectorized `where_array', so that the material can be rasterized. """
+        def where(r):
+            return self.return_value if geometry.where(r) else 0
+        where.where_array = geometry.where_array
+        return where
+        #}}}
+    def get_raster_weight(self, r):#{{{
+        """ Replaces the `where()' callback of the material number `self.current_material' (see get_material_weight()) """
+        return self.return_value * self.get_material_weight(self.current_material, r)
         #}}}
     def register_local(self, param, val):#{{{
         """ 
@@ -165,12 +449,17 @@ class AbstractMeepModel(meep.Callback):
 
         setattr(self, param, val)
 
+        if param in run_control_params:
+            meep.master_printf("  <run>   %s%s = %s (option of the simulation run)\n" % (param, " "*max(10-len(param), 0), val))
+            return
+        self.registered_params[param] = val
+
         nondefault = self.named_param_defaults.get(param, None) != val ## XXX
         if param in self.named_param_defaults.keys(): 
             if nondefault: infostring = "(user-set value accepted by the model)" 
             else: infostring = "(default value specified by the model)" 
         else:
-            if param in ('Kx', 'Ky', 'Kz', 'model', 'frequency', 'MaxTol', 'MaxIter', 'BiCGStab'): 
+            if param in script_params: 
                 infostring = "(user-set value used in the simulation scripts)" 
             else: infostring = "(unknown additional parameter)" 
 
@@ -213,22 +502,24 @@ class AbstractMeepModel(meep.Callback):
         It goes through all polarizabilities for all materials. 
         Applicable for time-domain simulation only, because dispersive model is not implemented for 
         frequency-domain simulation yet.
+
+        Any number of oscillators is allowed, see below.
         """
-        avail_cbs = [meep.DBL5, meep.DBL4, meep.DBL3, meep.DBL2, meep.DBL1,]
-        avail_cb_setters = [meep.set_DBL5_Callback, meep.set_DBL4_Callback, meep.set_DBL3_Callback, 
-                meep.set_DBL2_Callback, meep.set_DBL1_Callback,]
-        for material in self.materials:
+        for n, material in enumerate(self.materials):
             aeps = analytic_eps(material, self.src_freq)
             meep.master_printf("Info\tAdding material: %s with %d oscillator(s); (eps @ %.2e Hz = %.1f+%.3fj)\n" % 
                     (material.name, len(material.pol), self.src_freq, aeps.real, aeps.imag))
-            self.double_vec = material.where  ## redirect the double_vec() function callback
+            if self.material_raster is not None:
+                self.current_material = n
+                self.double_vec = self.get_raster_weight    ## look up the raster, or the memoized where() values
+            else:
+                self.double_vec = material.where  ## redirect the double_vec() function callback
             for polariz in material.pol:
-                if avail_cbs == []: 
-                    meep.master_printf("Error: too many oscillators defined in total (>5)."+"Perhaps the simulation can be made with less?")
-                    exit()
-                next_cb, next_cb_setter = avail_cbs.pop(), avail_cb_setters.pop()
+                ## MEEP evaluates the material function on the whole grid right when the susceptibility is added, 
+                ## and does not keep the callback afterwards; a single callback slot is thus reused for all oscillators
+                next_cb = meep.DBL1
                 self.return_value = polariz['sigma']
-                next_cb_setter(self.__disown__())    
+                meep.set_DBL1_Callback(self.__disown__())    
                 if "lorentzian_susceptibility" in dir(meep):
                     ## for meep 1.2 or newer
                     structure.add_susceptibility(next_cb, meep.E_stuff, 
@@ -322,12 +613,24 @@ class AbstractMeepModel(meep.Callback):
         #}}}
     def test_materials(self, verbose="false"):#{{{
         """ 
-        1) Verify the material definition will not introduce instabilities in FDTD
-        2) Call the where() function for each material, in order to make sure there are no errors
+        1) Verify the material definition will not introduce instabilities in FDTD, and report the stability margins
+        2) Call the where() function for each material on a coarse grid, in order to make sure there are no errors
         (SWIG callback does not report where the error occured, it just crashes) 
+        3) Report the volume fraction each material fills, and where the materials overlap (note that their 
+        permittivities and polarizabilities sum up there, see get_static_permittivity())
+
+        The grid is evaluated on the master process only, using the vectorized `where_array()' where available.
         """
         f_c = self.f_c()
-        for n, material in enumerate(self.materials): 
+        eps_minimum = meep.use_Courant()**2 * 3 # for three dimensions (2-D simulations are safer as they multiply by 2 only, but it is ignored here)
+        for n, material in enumerate(self.materials[:]):   ## (removing from a list requires iterating over its copy)
+            if not callable(material.where):
+                meep.master_printf("\n\tWARNING: `where' parameter is not a function, material not used: %s\n\n" % (material.name))
+                self.materials.remove(material)
+                continue
+            if meep.my_rank() != 0:     ## (the materials are removed on all processes, but checked on the master only)
+                continue
+
             ## Check the stability criterion that no oscillator may be above the cricital frequency f_c (MEEP checks this, but perhaps in a wrong way)
             for osc in material.pol:
                 if osc['omega'] > f_c: 
@@ -336,22 +639,52 @@ class AbstractMeepModel(meep.Callback):
 
             ## Check the stability criterion that at f_c, real part of permittivity must be higher than ca. 0.87
             eps_fc      = analytic_eps(material, f_c)
-            eps_minimum = meep.use_Courant()**2 * 3 # for three dimensions (2-D simulations are safer as they multiply by 2 only, but it is ignored here)
             if (eps_fc.real < eps_minimum):
                 meep.master_printf("\n\tWARNING: at the critical frequency %f, real permittivity of %s is below the criterion for stability (%f < %f)"
                         % (f_c, material.name, eps_fc, eps_minimum))
 
-            ## Test whether the `where()' function 
-            if callable(material.where):    
-                for x in np.linspace(-self.size_x/2, self.size_x/2, 15):
-                    for y in np.linspace(-self.size_y/2, self.size_y/2, 15):
-                        if self.size_z:     # 3D case
-                            for z in np.linspace(-self.size_z/2, self.size_z/2, 15): material.where(meep.vec(x, y, z))
-                        else:               # 2D case
-                            material.where(meep.vec(x, y))
-            else:       
-                meep.master_printf("\n\tWARNING: `where' parameter is not a function, material not used: %s\n\n" % (material.name))
-                self.materials.remove(material)
+        if meep.my_rank() != 0: 
+            return
+
+        ## Evaluate all materials on a coarse grid (15 points along each axis limit the scalar fallback to 15**3 callbacks)
+        axes = [np.linspace(-self.size_x/2, self.size_x/2, 15), np.linspace(-self.size_y/2, self.size_y/2, 15), 
+                np.linspace(-self.size_z/2, self.size_z/2, 15) if self.size_z else np.array([0.])]
+        shape = tuple(len(axis) for axis in axes)
+        presences = []
+        for material in self.materials:
+            presence = np.zeros(shape)
+            where_array = get_where_array(material)
+            if where_array is not None:
+                presence[:] = where_array(*np.ix_(*axes))
+            else:                   ## (the scalar fallback)
+                return_value, self.return_value = self.return_value, 1
+                for i, j, k in np.ndindex(shape):
+                    if self.size_z:     # 3D case
+                        presence[i,j,k] = material.where(meep.vec(axes[0][i], axes[1][j], axes[2][k]))
+                    else:               # 2D case
+                        presence[i,j,k] = material.where(meep.vec(axes[0][i], axes[1][j]))
+                self.return_value = return_value
+            presences.append(presence)
+
+            ## Report the volume fraction and the stability margins
+            eps_fc = analytic_eps(material, f_c).real
+            meep.master_printf("Info\tMaterial %s fills %.2f%% of the volume; eps'(f_c) = %.2f is %.2f above the stability limit" % 
+                    (material.name, 100*np.mean(presence), eps_fc, eps_fc-eps_minimum))
+            if material.pol:
+                meep.master_printf("; highest oscillator at %.3f f_c" % (max(osc['omega'] for osc in material.pol)/f_c))
+            meep.master_printf("\n")
+
+        ## Report the overlapping materials 
+        for n1 in range(len(self.materials)):
+            for n2 in range(n1+1, len(self.materials)):
+                overlap = np.logical_and(presences[n1] > 0, presences[n2] > 0)
+                if np.any(overlap):
+                    where_overlap = [axis[np.nonzero(np.any(overlap, axis=tuple(a for a in range(3) if a != dim)))[0]] 
+                            for (dim, axis) in enumerate(axes)]
+                    meep.master_printf(("\n\tWARNING: materials %s and %s overlap in %.2f%% of the volume, within x=(%.3g, %.3g), "+
+                            "y=(%.3g, %.3g), z=(%.3g, %.3g)\n\t         Their permittivities and polarizabilities are summed there.\n\n") % 
+                            ((self.materials[n1].name, self.materials[n2].name, 100*np.mean(overlap)) + 
+                            tuple(val for axis in where_overlap for val in (axis[0], axis[-1]))))
         #}}}
 
 ## Geometrical primitives to help defining the geometry and  structure rotation
@@ -375,15 +708,166 @@ def in_ellipsoid(r,cx,cy,cz,rad,ex):
 ## The following three functions rotate the meep's position vector (= an object providing x(), y(), z() methods)  
 ## All structures defined below the transformation in the following form:    r = self.RotatedCoordsY(r, angle=np.pi/4)
 ## will appear rotated along the respective axis. Rotations may be stacked as needed, but note they are not commutative. 
+## The cosine and sine of each angle are computed only once (see cos_sin()).
 def rotatedX(self, r, angle):
-    x,y,z,c,s = r.x(), r.y(), r.z(), np.cos(angle), np.sin(angle)
+    x,y,z,(c,s) = r.x(), r.y(), r.z(), cos_sin(angle)
     return  meep.vec(x,         y*c+z*s,        z*c-y*s)
 def rotatedY(self, r, angle):
-    x,y,z,c,s = r.x(), r.y(), r.z(), np.cos(angle), np.sin(angle)
+    x,y,z,(c,s) = r.x(), r.y(), r.z(), cos_sin(angle)
     return  meep.vec(x*c-z*s,   y,              z*c+x*s)
 def rotatedZ(self, r, angle):
-    x,y,z,c,s = r.x(), r.y(), r.z(), np.cos(angle), np.sin(angle)
-    return  meep.vec(x*c+y*s,   y*c-x*s,        z)          # }}}
+    x,y,z,(c,s) = r.x(), r.y(), r.z(), cos_sin(angle)
+    return  meep.vec(x*c+y*s,   y*c-x*s,        z)          
+_cos_sin_memo = {}
+def cos_sin(angle):
+    if angle not in _cos_sin_memo: 
+        _cos_sin_memo[angle] = (float(np.cos(angle)), float(np.sin(angle)))
+    return _cos_sin_memo[angle]
+def rotation_matrix(axis, angle):
+    """ Returns the 3x3 matrix that transforms the coordinates in the same way as the rotatedX/Y/Z() functions """
+    c, s = cos_sin(angle)
+    if   axis == 'x':  return np.array([[1, 0, 0], [0, c, s], [0,-s, c]])
+    elif axis == 'y':  return np.array([[c, 0,-s], [0, 1, 0], [s, 0, c]])
+    elif axis == 'z':  return np.array([[c, s, 0], [-s,c, 0], [0, 0, 1]])
+    raise ValueError("Rotation axis must be one of 'x', 'y', 'z'")
+# }}}
+
+## Constructive solid geometry (CSG): the same primitives as above, but as objects that can be combined together 
+## and evaluated on whole coordinate arrays at once. Example of a hollow sphere with a wire, repeated in 3 cells:
+##     g = Repeat((Sphere(rad=30e-6) - Sphere(rad=20e-6)) | XCyl(rad=5e-6), axis='z', pitch=100e-6, count=3)
+## A material can then use  where=model.where_geometry(g)  that provides both the scalar and vectorized function.
+class Geometry():#{{{
+    """ Base class of all geometric objects. Each object implements the `where_array(x, y, z)' method that accepts 
+    coordinate arrays (broadcastable against each other) and returns a boolean array, True inside the object.
+
+    Objects are combined with the operators | (union), & (intersection) and - (difference), and can be 
+    moved by the translated() and rotated() methods. """
+    def where_array(self, x, y, z):
+        raise NotImplementedError
+    def where(self, r):
+        """ Scalar evaluation at a single meep.vec, for backward compatibility with the `where()' functions """
+        return bool(self.where_array(r.x(), r.y(), r.z()))
+    __call__ = where
+    def __or__(self, other):    return Union(self, other)
+    def __and__(self, other):   return Intersection(self, other)
+    def __sub__(self, other):   return Difference(self, other)
+    def translated(self, dx=0, dy=0, dz=0):     return Translate(self, dx, dy, dz)
+    def rotated(self, axis, angle):             return Rotate(self, axis, angle)
+#}}}
+class XSlab(Geometry):#{{{
+    def __init__(self, d, cx=0):            self.d, self.cx = d, cx
+    def where_array(self, x, y, z):         return abs(x-self.cx) < self.d/2
+class YSlab(Geometry):
+    def __init__(self, d, cy=0):            self.d, self.cy = d, cy
+    def where_array(self, x, y, z):         return abs(y-self.cy) < self.d/2
+class ZSlab(Geometry):
+    def __init__(self, d, cz=0):            self.d, self.cz = d, cz
+    def where_array(self, x, y, z):         return abs(z-self.cz) < self.d/2
+class XCyl(Geometry):
+    def __init__(self, rad, cy=0, cz=0):    self.rad, self.cy, self.cz = rad, cy, cz
+    def where_array(self, x, y, z):         return (y-self.cy)**2 + (z-self.cz)**2 < self.rad**2
+class YCyl(Geometry):
+    def __init__(self, rad, cx=0, cz=0):    self.rad, self.cx, self.cz = rad, cx, cz
+    def where_array(self, x, y, z):         return (x-self.cx)**2 + (z-self.cz)**2 < self.rad**2
+class ZCyl(Geometry):
+    def __init__(self, rad, cx=0, cy=0):    self.rad, self.cx, self.cy = rad, cx, cy
+    def where_array(self, x, y, z):         return (x-self.cx)**2 + (y-self.cy)**2 < self.rad**2
+class Sphere(Geometry):
+    def __init__(self, rad, cx=0, cy=0, cz=0):  
+        self.rad, self.cx, self.cy, self.cz = rad, cx, cy, cz
+    def where_array(self, x, y, z):         
+        return (x-self.cx)**2 + (y-self.cy)**2 + (z-self.cz)**2 < self.rad**2
+class Ellipsoid(Geometry):
+    """ The same shape as in_ellipsoid(): elongated by the factor `ex' along the x=-y diagonal """
+    def __init__(self, rad, ex, cx=0, cy=0, cz=0):  
+        self.rad, self.ex, self.cx, self.cy, self.cz = rad, ex, cx, cy, cz
+    def where_array(self, x, y, z):
+        xd, yd, zd = (self.cx-x), (self.cy-y), (self.cz-z)
+        return (xd+yd)**2/2.*self.ex**2 + (xd-yd)**2/2./self.ex**2 + zd**2 < self.rad**2
+#}}}
+class Union(Geometry):#{{{
+    def __init__(self, *children):          self.children = children
+    def where_array(self, x, y, z):
+        return reduce(np.logical_or, [child.where_array(x, y, z) for child in self.children])
+class Intersection(Geometry):
+    def __init__(self, *children):          self.children = children
+    def where_array(self, x, y, z):
+        return reduce(np.logical_and, [child.where_array(x, y, z) for child in self.children])
+class Difference(Geometry):
+    def __init__(self, base, subtracted):   self.base, self.subtracted = base, subtracted
+    def where_array(self, x, y, z):
+        return np.logical_and(self.base.where_array(x, y, z), np.logical_not(self.subtracted.where_array(x, y, z)))
+class Transform(Geometry):
+    """ Evaluates the object in the affinely transformed coordinates  (x', y', z') = matrix . (x, y, z) + offset.
+    The matrix is composed once when the object is defined: if the transformed object is a Transform again 
+    (e.g. several rotations and translations stacked), both are merged into one. The coordinate arrays are then 
+    transformed only once, and the zero elements of the matrix cost nothing. """
+    def __init__(self, child, matrix=np.eye(3), offset=(0,0,0)):
+        matrix, offset = np.array(matrix, dtype=float), np.array(offset, dtype=float)
+        if isinstance(child, Transform):        ## collapse the nested transforms 
+            matrix, offset = np.dot(child.matrix, matrix), np.dot(child.matrix, offset) + child.offset
+            child = child.child
+        self.child, self.matrix, self.offset = child, matrix, offset
+    def transform_coords(self, x, y, z):
+        """ Returns the transformed coordinates (arrays or numbers) """
+        result = []
+        for row, offset in zip(self.matrix, self.offset):
+            coord = offset
+            for coef, xyz in zip(row, (x, y, z)):
+                if coef == 1:   coord = coord + xyz
+                elif coef:      coord = coord + coef*xyz
+            result.append(coord)
+        return result
+    def where_array(self, x, y, z):         return self.child.where_array(*self.transform_coords(x, y, z))
+class Translate(Transform):
+    def __init__(self, child, dx=0, dy=0, dz=0):    
+        Transform.__init__(self, child, offset=(-dx, -dy, -dz))
+class Rotate(Transform):
+    """ Rotates the object along the 'x', 'y' or 'z' axis, in the same sense as the rotatedX/Y/Z() functions """
+    def __init__(self, child, axis, angle):         
+        Transform.__init__(self, child, matrix=rotation_matrix(axis, angle))
+class Repeat(Geometry):
+    """ Places `count' copies of the object along the axis, with the given pitch and centered around zero. 
+    The object is evaluated in the coordinates folded by lattice_fold() into the nearest cell, and also relative 
+    to both neighbouring cells, so that the copies may overlap (e.g. spheres of radius greater than pitch/2); 
+    only an object extending further than 1.5 pitch from its center would be clipped. """
+    def __init__(self, child, axis, pitch, count):  self.child, self.axis, self.pitch, self.count = child, axis, pitch, count
+    def where_array(self, x, y, z):
+        if self.count < 1: 
+            return np.zeros(np.broadcast(x, y, z).shape, dtype=bool)
+        if self.axis not in ('x', 'y', 'z'):
+            raise ValueError("Repetition axis must be one of 'x', 'y', 'z'")
+        coords = [x, y, z]
+        n = 'xyz'.index(self.axis)
+        coord, offset = coords[n], (self.count-1)/2.
+        index = lattice_index(coord, self.pitch, self.count)
+        result = None
+        for shift in ((-1, 0, 1) if self.count > 1 else (0,)):
+            cell = index + shift
+            coords[n] = coord - (cell-offset)*self.pitch        ## (relative to the center of the cell)
+            inside = self.child.where_array(*coords)
+            if shift:       ## (the neighbouring cell must exist)
+                inside = np.logical_and(inside, np.logical_and(cell >= 0, cell <= self.count-1))
+            result = inside if result is None else np.logical_or(result, inside)
+        return result
+#}}}
+def lattice_index(coord, pitch, count, center=0):#{{{
+    """ The index (0 to count-1) of the nearest of `count' unit cells with the given pitch, centered around `center' """
+    return np.clip(np.round((coord-center)/pitch + (count-1)/2.), 0, count-1)
+#}}}
+def lattice_fold(coord, pitch, count, center=0):#{{{
+    """ Folds the coordinate (a number or an array) into the nearest of `count' unit cells with the given pitch, 
+    centered around `center'. Returns the coordinate relative to the center of that cell, so that a structure 
+    needs to be defined for one cell only, at the cost of one evaluation regardless of the number of cells.
+
+    The cells at both ends extend to infinity, i.e. the result equals `coord-cellc' where `cellc' is the cell 
+    center nearest to `coord'. Note that only the nearest cell is considered, so an object extending past pitch/2 
+    is clipped at the cell boundary (Repeat checks also the neighbouring cells). Usage in a scalar `where()' function:
+        rc = meep.vec(r.x(), r.y(), lattice_fold(r.z(), self.cellsize, self.cellnumber))
+        if in_sphere(rc, cx=0, cy=0, cz=0, rad=self.radius): return self.return_value
+    """
+    return coord - center - (lattice_index(coord, pitch, count, center)-(count-1)/2.)*pitch
+#}}}
 
 ## The band source is useful, but is not guaranteed to be compiled in:
 band_src_time = meep.band_src_time if ('band_src_time' in dir(meep)) else meep.gaussian_src_time
@@ -416,6 +900,55 @@ f.add_volume_source(meep.Ex, srctype, srcvolume, meep.AMPL)
 
 
 ## === Initialization of the materials, structure and whole simulation ===
+def yee_lattice_axis(size, resolution):#{{{
+    """ Coordinates of all points of the Yee lattice (i.e. with the step of half a voxel) along one axis of the
+    volume with center_origin() called. The number of voxels is rounded in the same way as in meep.vol3d(). """
+    voxels = max(int(size/resolution + .5), 1)
+    return (np.arange(2*voxels+1) - voxels) * resolution/2.
+#}}}
+def lattice_axis(size, resolution):#{{{
+    """ Coordinates of the points of the dielectric grid of MEEP (i.e. every second point of the Yee lattice, 
+    where get_complex_array_slice() interpolates the fields) along one axis of the whole cell, including both 
+    its faces. """
+    return yee_lattice_axis(size, resolution)[::2]
+#}}}
+def rasterize(where_array, axes, resolution, subpixel=1):#{{{
+    """ Evaluates the vectorized `where_array(x, y, z)' function on the lattice given by the three coordinate `axes'. 
+    With subpixel > 1, each point is averaged over subpixel**3 (or subpixel**2 in 2D) points evenly spread in the cube 
+    of half-voxel size around it, giving the fill fraction of the material. """
+    shape = tuple(len(axis) for axis in axes)
+    offsets = ((np.arange(subpixel)+.5)/subpixel - .5) * resolution/2
+    z_offsets = offsets if shape[2] > 1 else [0.]
+    x, y, z = np.ix_(*axes)
+    raster = np.zeros(shape, dtype=np.float32)
+    for dx in offsets:
+        for dy in offsets:
+            for dz in z_offsets:
+                raster += where_array(x+dx, y+dy, z+dz)     ## (broadcasts the result onto the full lattice)
+    raster /= len(offsets)**2 * len(z_offsets)
+    return raster
+#}}}
+raster_cache_version = 2        ## (increase if the format or the meaning of the cached rasters changes)
+def save_raster_cache(cache_file, material_raster):#{{{
+    """ Stores the rasterized materials (skipping the None items) in a compressed .npz file. The file is first written 
+    under a temporary name and then renamed, so that a concurrently started run never loads an incomplete file. """
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir): 
+        os.makedirs(cache_dir)
+    temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(temp_file, "wb") as outfile:
+        np.savez_compressed(outfile, **dict(('material%d' % n, raster) for (n, raster) in enumerate(material_raster) 
+                if raster is not None))
+    os.rename(temp_file, cache_file)
+#}}}
+def get_where_array(material):#{{{
+    """ Returns the vectorized `where_array(x, y, z)' function of the material, or None if it is not available.
+    It may be given either as an attribute of the material, or of its `where' object. """
+    where_array = getattr(material, 'where_array', None)
+    if where_array is None: 
+        where_array = getattr(material.where, 'where_array', None)
+    return where_array
+#}}}
 def permittivity2conductivity(complex_eps, freq):#{{{
     """
     Enables to use the same dispersive materials for time- and frequency-domain simulation
@@ -459,170 +992,115 @@ def analytic_eps(mat, freq):#{{{
         #complex_eps += polariz['sigma'] * polariz['omega']**2 / (polariz['omega']**2 - omega**2 - 1j*omega*polariz['gamma']) 
     return complex_eps 
 #}}}
+def first_material_value(model, material_values, r, default):#{{{
+    """ Returns the value from `material_values' for the first material present at `r', or the default one if none is.
+    The materials are looked up in the raster (or memoized), if the model has been rasterized by init_structure().  """
+    for n, value in enumerate(material_values):
+        if model.material_raster is not None:
+            if model.get_material_weight(n, r): return value
+        elif model.materials[n].where(r): 
+            return value
+    return default
+#}}}
 class MyHiFreqPermittivity(meep.Callback):#{{{      %% TODO rename to Permittivity_callback
     def __init__(self, model, frequency):
         meep.Callback.__init__(self)
         self.model = model
         self.frequency = frequency
+        ## The permittivity depends only on the material and frequency, so it is computed once for each material
+        self.material_values = [analytic_eps(material, frequency).real for material in model.materials]
     def double_vec(self, r):
-        for material in self.model.materials:
-            if material.where(r):
-                return analytic_eps(material, self.frequency).real
-        else: return 1
+        return first_material_value(self.model, self.material_values, r, default=1)
 #}}}
 class MyConductivity(meep.Callback):#{{{            %% TODO rename to Conductivity_callback
     def __init__(self, model, frequency):
         meep.Callback.__init__(self)
         self.model = model
         self.frequency = frequency
+        ## The conductivity depends only on the material and frequency, so it is computed once for each material
+        self.material_values = [permittivity2conductivity(analytic_eps(material, frequency), frequency) 
+                for material in model.materials]
     def double_vec(self, r):
-        for material in self.model.materials:
-            if material.where(r):
-                return permittivity2conductivity(analytic_eps(material, self.frequency), self.frequency)
-        else: return 0
+        return first_material_value(self.model, self.material_values, r, default=0)
 #}}}
 
-def annotate_frequency_axis(mark_freq, label_position_y=1, arrow_length=3, log_y=False):#{{{
-    """
-    """
-    import matplotlib.pyplot as plt
-    if type(mark_freq) in (float,int): mark_freq=list(mark_freq,)
-    if type(mark_freq) in (list,tuple): mark_freq=dict(zip(mark_freq,['' for mf in mark_freq]))
-    for mfreq, mfreqtxt in mark_freq.items(): 
-        label_y2 = label_position_y
-        while (mfreqtxt[0:1]==' ' and mfreqtxt[-2:-1]==' '): 
-            label_y2 = label_y2*2 if log_y else label_y2+1
-            mfreqtxt=mfreqtxt[1:-1]; 
-        bboxprops   = dict(boxstyle='round, pad=.15', fc='white', alpha=1, lw=0)
-        arrowprops  = dict(arrowstyle=('->', '-|>', 'simple', 'fancy')[0], connectionstyle = 'arc3,rad=0', lw=1, ec='k', fc='w')
-        plt.annotate(mfreqtxt,                    
-                xy      = (mfreq, label_y2),    xycoords  ='data',
-                xytext  = (mfreq, label_y2*arrow_length if log_y else label_y+arrow_length),  textcoords='data',        # (delete this if text without arrow is used)
-                ha='center', va='bottom', size=15, color='k',
-                bbox        = bboxprops,        # comment out to disable bounding box
-                arrowprops  = arrowprops,       # comment out to disable arrow
-                )
+def annotate_frequency_axis(*args, **kwargs):#{{{
+    """ See meep_utils_plot.annotate_frequency_axis() """
+    import meep_utils_plot
+    meep_utils_plot.annotate_frequency_axis(*args, **kwargs)
 #}}}
 def plot_eps(*args, **kwargs):#{{{
-    try: plot_eps_(*args, **kwargs)
-    except: meep.master_printf("Could not plot the material permittivity spectra, probably matplotlib bug. Skipping it...")
-    #}}}
-def plot_eps_(to_plot, filename="epsilon.png", plot_conductivity=True, freq_range=(1e10, 1e18), mark_freq=[], draw_instability_area=None):#{{{
-    """ Plots complex permittivity of the materials to a PNG file
+    """ Plots complex permittivity of the materials to a PNG file, see meep_utils_plot.plot_eps_() 
 
-    Accepts list of materials
+    Only the master process plots; the plotting module and matplotlib are imported at the first call.
     """
-
-    #for material in list(to_plot): ## autoscale x axis?
-        #for pol in material.pol:
-            #if freq_range[1] < pol['omega']: freq_range[1] = pol['omega']*2
-
-    frequency = 10**np.arange(np.log10(freq_range[0]), np.log10(freq_range[1]), .01)
-
-    plt.figure(figsize=(7,6))
-    #colors = ['#000000', '#004400', '#003366', '#000088', '#440077', '#661100', 
-              #'#aa8800', '#00aa00', '#0099dd', '#0000EE', '#2200DD', '#aa0000']
-    colors = ['#000000', '#004400', '#003366', '#000088', '#440077', '#661100', 
-              '#aa8800', '#0044dd', '#00bb00', '#aaaa00', '#bb6600', '#dd0000']
-
-    subplotnumber = 2 if plot_conductivity else 1
-
-
-    for material in list(to_plot):
-        if colors: color = colors.pop()
-        else: color = 'black'
-        label = getattr(material, 'shortname', material.name)
-        plt.subplot(subplotnumber,1,1)
-
-        eps = np.conj(analytic_eps(material, frequency)) ## FIXME eps should be computed as conjugated by default
-
-        plt.subplot(subplotnumber,1,1)
-        plt.plot(frequency, np.real(eps), color=color, label=material.name, ls='-') #  
-        plt.plot(frequency, np.imag(eps), color=color, label='', ls='--') # 
-        #R = abs((1-eps**.5)/(1+eps**.5))**2     ## Intensity reflectivity
-
-        if plot_conductivity:
-            plt.subplot(subplotnumber,1,2)
-            label = ""
-            omega = 2*np.pi*frequency
-            cond = eps * omega * epsilon_0 * 1j ## for positive frequency convention
-            #cond = eps * omega * epsilon_0 / 1j ## for negative frequency convention
-
-            plt.plot(frequency, np.real(cond), color=color, label=material.name, ls='-')
-            plt.plot(frequency, np.imag(cond), color=color, label="#", ls='--')
-
-
-            #plt.plot(frequency, np.real(1./cond)*1e12, color=color, lw=1.5, label=("$\\rho^{'}\cdot 10^{12}$"), ls=':') ## (real) resistivity
-
-            # XXX temporary
-            #gamma = 1.5e+13
-            #f_p = 2.07153080589e+14
-            #omega_p =  1.3015811923e+15
-            #omega_p = 1.3015811923e+15 # / (2*np.pi)**.5
-
-            ## Low-frequency limits for pseudo-Drude model
-            #plt.plot(frequency, np.ones_like(omega) * omega_p**2 * epsilon_0 / gamma, color='k', label=label, ls='-', lw=.3)
-            #plt.plot(frequency, omega * (-epsilon_0 + omega_p**2 * epsilon_0 / gamma**2), color='k', label=label, ls='--', lw=.3)
-            ## High-frequency limits for pseudo-Drude model
-            #plt.plot(frequency, omega**-2 * (omega_p**2 * epsilon_0 * gamma), color='g', label=label, ls='-', lw=.3)
-            #plt.plot(frequency, omega * -epsilon_0            , color='g', label=label, ls='--', lw=.3)
-                                                    #^??????^/(2*np.pi)
-            # XXX                   #  ^^ ?????????? ^
-
-            ## TODO check this and perhaps remove:
-            #plt.subplot(subplotnumber,1,3)
-            #plt.plot(frequency, -np.real(cond), color=color, label=label, ls='-')
-            #plt.plot(frequency, -np.imag(cond), color=color, label="", ls='--')
-            #
-            #
-            #plt.ylabel(u"negative valued")
-            #plt.yscale('log'); 
-            #plt.xscale('log'); plt.legend(); plt.grid(True)
-
-
-
-    ## Annotate frequencies and finish the graph 
-    plt.subplot(subplotnumber,1,1)
-    plt.legend(prop={'size':8}, loc='lower right') 
-    plt.xlabel(u"frequency $f$ [Hz]") 
-    plt.ylabel(u"relative permittivity $\\varepsilon_r$")
-    plt.grid(True)
-    plt.xscale('log')
-    ylim = (-1e7, 1e6); plt.ylim(ylim); plt.yscale('symlog')
-    annotate_frequency_axis(mark_freq, log_y=True, arrow_length=50) # TODO , print_freq=True
-    if draw_instability_area:
-        plt.gca().add_patch(plt.Rectangle((draw_instability_area[0], ylim[0]), 1e20, draw_instability_area[1]-ylim[0], color='#bbbbbb'))
-
-    if plot_conductivity:
-        plt.subplot(subplotnumber,1,2)
-        plt.ylabel(u"conductivity $\\sigma$")
-        plt.xscale('log'); plt.grid(True)
-        plt.yscale('symlog'); plt.ylim((-1e12, 1e12)); 
-        plt.xlabel(u"frequency $f$ [Hz]") 
-
-    plt.xlabel(u"frequency $f$ [Hz]") 
-    plt.savefig(filename, bbox_inches='tight')
+    if meep.my_rank() != 0: return
+    import meep_utils_plot
+    meep_utils_plot.plot_eps(*args, **kwargs)
 #}}}
 
-def init_structure(model, volume, pml_axes):#{{{
+def component_direction(comp):#{{{
+    """ The direction of a field component (meep.X for meep.Ex, meep.Hx etc.) """
+    if hasattr(meep, 'component_direction'): 
+        return meep.component_direction(comp)
+    for (direction, comps) in ((meep.X, ('Ex', 'Hx', 'Dx', 'Bx')), (meep.Y, ('Ey', 'Hy', 'Dy', 'By')), (meep.Z, ('Ez', 'Hz', 'Dz', 'Bz'))):
+        if comp in [getattr(meep, name) for name in comps if hasattr(meep, name)]: 
+            return direction
+#}}}
+def mirror_parity(comp, direction, phase):#{{{
+    """ The factor by which the field component `comp' differs in the mirror image of a point, if the fields have 
+    the mirror symmetry (direction, phase). As in MEEP, the phase is defined for the electric field as a vector; 
+    its component normal to the plane changes its sign, and the magnetic field (a pseudovector) gets the opposite sign.
+
+    E.g. a plane wave polarized along x has the symmetries (meep.X, -1) and (meep.Y, 1), and both its Ex and Hy 
+    components are even (i.e. the parity is 1). """
+    sign = -1 if component_direction(comp) == direction else 1
+    if meep.is_magnetic(comp) or meep.is_B(comp): sign = -sign
+    return phase * sign
+#}}}
+def init_structure(model, volume, pml_axes, raster_cache=None, mirrors=()):#{{{
     """
     This routine wraps the usual tasks needed to set up a realistic simulation with meep.
 
     `model' and `volume' are objects that need to be passed from the main simulation
 
     `pml_axes' may be selected from these: None, meep.X, meep.XY, meep.Y or meep.Z or "All" 
+
+    `raster_cache' is an optional directory where the rasterized materials are stored, so that the runs with the
+    same geometry (e.g. in a scan of losses or of simtime) skip its evaluation. It can be also given as the 
+    `raster_cache' command-line parameter of the model.
+
+    `mirrors' is a list of the mirror symmetries (direction, phase) of the fields (see mirror_parity()). Those to which 
+    the materials are symmetric (see AbstractMeepModel.check_symmetry()) are passed to MEEP, so that only a half or 
+    a quarter of the volume is computed; they are stored as `model.mirrors'.
     """
+    def get_symmetry():
+        symmetry = meep.identity()
+        for (direction, phase) in model.mirrors:
+            symmetry = symmetry + meep.mirror(direction, volume) * complex(phase)
+        return symmetry
     def init_perfectly_matched_layers():
         if pml_axes == "All" or pml_axes == "all":
             perfectly_matched_layers=meep.pml(model.pml_thickness)
-            s = meep.structure(volume, meep.EPS, perfectly_matched_layers, meep.identity())
+            s = meep.structure(volume, meep.EPS, perfectly_matched_layers, get_symmetry())
         elif pml_axes == None or pml_axes == "none" or pml_axes == "None":
-            s = meep.structure(volume, meep.EPS)
+            if model.mirrors: s = meep.structure(volume, meep.EPS, meep.no_pml(), get_symmetry())
+            else:             s = meep.structure(volume, meep.EPS)
         else:
             perfectly_matched_layers=meep.pml(model.pml_thickness, pml_axes)
-            s = meep.structure(volume, meep.EPS, perfectly_matched_layers, meep.identity())
+            s = meep.structure(volume, meep.EPS, perfectly_matched_layers, get_symmetry())
         return s
 
+    ## Evaluate the vectorized materials at once (if there are any), the callbacks below will only look them up
+    model.build_material_raster(cache_dir=raster_cache or getattr(model, 'raster_cache', None))
+
+    ## Use only the mirror symmetries that the structure really has
+    symmetric_planes = model.check_symmetry([direction for (direction, phase) in mirrors]) if mirrors else []
+    model.mirrors = [(direction, phase) for (direction, phase) in mirrors if direction in symmetric_planes]
+    if model.mirrors: 
+        meep.master_printf("Info\tUsing %d mirror symmetries, the computed volume is reduced %d times\n" % 
+                (len(model.mirrors), 2**len(model.mirrors)))
+
     if not getattr(model, 'frequency', None):
         meep.master_printf("== Time domain structure setup ==\n")
         ## Define each polarizability by redirecting the callback to the corresponding "where_material" function
@@ -666,34 +1144,6 @@ def run_bash(cmd, anyprocess=False): #{{{
         out = p.stdout.read().strip()
         return out
 #}}}
-def savetxt(fname, X, header, **kwargs):#{{{ 
-    """
-    Its use is for older versions of the library that do not accept the `header' parameter
-    """
-    #FIXME - This function will be superseded by numpy.savetxt
-    with open(fname, "w") as outfile: 
-        outfile.write(header)
-        np.savetxt(outfile, X, **kwargs)
-#}}}
-def loadtxt_params(filename): #{{{
-    parameters  = {}
-    with open(filename) as datafile:
-        for line in datafile:
-            if (line[0:1] in '0123456789') or ('column' in line.lower()): break    # end of parameter list
-            key, value = line.replace(',', ' ').split()[-2:]
-            try: value = float(value) ## Try to convert to float, if possible
-            except: pass                ## otherwise keep as string
-            parameters[key] = value
-    return parameters
-#}}}
-def loadtxt_columns(filename): #{{{
-    columns     = []
-    with open(filename) as datafile:
-        for line in datafile:
-            if ('column' in line.lower()): columns.append(line.strip().split(' ', 1)[-1]) # (todo) this may need fixing to avoid collision
-    return columns
-#}}}
-
 ## Useful for making 3D snapshots of the fields
 class Slice(): #{{{
     """ Exports a slice through the fourdimensional field information in space-time.
@@ -818,6 +1268,12 @@ class Slice(): #{{{
                 self.field.output_hdf5(component, self.volume, self.openfile, 1) 
             self.last_slice_time = now
 
+    def next_due(self):
+        """ The time after which poll() saves the next slice (np.inf if no more slices are to be saved) """
+        if self.images_number == 0: return self.at_t[0]
+        due = max(self.at_t[0], self.last_slice_time + self.min_timestep)
+        return due if due < self.at_t[1] else np.inf
+
     def finalize(self, forcesave=True):
         if forcesave:
             self.images_number += 1 
@@ -853,8 +1309,9 @@ class Slice(): #{{{
     #}}}
 
 ## Obtain and process the s-parameters of the structure 
-def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
-        frequency_domain=False, frequency=None, pad_zeros=0.0, intf=[0, np.inf], Kx=0, Ky=0, eps1=1, eps2=1, diag=True):
+def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex=None, monitor2_Hy=None, #{{{
+        frequency_domain=False, frequency=None, pad_zeros=0.0, intf=[0, np.inf], Kx=0, Ky=0, eps1=1, eps2=1, diag=True,
+        extrapolate=0):
     """ Returns the frequency, s11 (reflection) and s12 (transmission) spectra
     (works for both time- and freq-domain simulation) 
 
@@ -865,25 +1322,68 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
     MP1 and MP2 are monitor planes provided                              +------structure--+           
 
     Allows to separate forward/backward waves even under oblique incidence
+
+    Instead of the four monitors, two MonitorPort's may be given, i.e. get_s_parameters(port1, port2, ...). Then 
+    the ports separate the waves, and their `eps' is used instead of eps1 and eps2.
+
+    If `extrapolate' > 0, the time-domain records are prolonged by this factor using the decaying oscillators 
+    fitted to their tails (see harminv_wrapper.harminv_extrapolate()). This suppresses the spectral leakage of 
+    high-Q resonances in short simulations. The residual of the fit is printed and added to the returned header.
     """
     ## TODO document function parameters
     ## TODO allow omitting second monitor (-> returns s12=None)
 
-    t, Ex1 = monitor1_Ex.get_waveforms()
-    t, Hy1 = monitor1_Hy.get_waveforms()
-    t, Ex2 = monitor2_Ex.get_waveforms()
-    t, Hy2 = monitor2_Hy.get_waveforms()
-
-    ## Hann-window fadeout to suppress spectral leakage
-    if not frequency_domain:
-        for field in (Ex1, Hy1, Ex2, Hy2):
-            field[t>max(t)*.8] = field[t>max(t)*.8]*(.5 + .5*np.cos(np.pi * (t[t>max(t)*.8]/max(t)-.8)/(1-.8)))
+    ## Monitors with the running Fourier transform provide directly the spectra (already Hann-windowed)
+    running_dft = (getattr(monitor1_Ex, 'dft_freq', None) is not None)
+    ports = isinstance(monitor1_Ex, MonitorPort)
+    if ports:
+        port1, port2 = monitor1_Ex, monitor1_Hy
+        if running_dft: 
+            (freq, data1), (freq, data2) = port1.get_spectrum(), port2.get_spectrum()
+        else:
+            (t, data1), (t, data2) = port1.get_waveforms(), port2.get_waveforms()
+        Ex1, Hy1 = port1.get_component(data1, meep.Ex), port1.get_component(data1, meep.Hy)
+        Ex2, Hy2 = port2.get_component(data2, meep.Ex), port2.get_component(data2, meep.Hy)
+    elif running_dft:
+        freq, Ex1 = monitor1_Ex.get_spectrum()
+        freq, Hy1 = monitor1_Hy.get_spectrum()
+        freq, Ex2 = monitor2_Ex.get_spectrum()
+        freq, Hy2 = monitor2_Hy.get_spectrum()
+        t = None
+    else:
+        t, Ex1 = monitor1_Ex.get_waveforms()
+        t, Hy1 = monitor1_Hy.get_waveforms()
+        t, Ex2 = monitor2_Ex.get_waveforms()
+        t, Hy2 = monitor2_Hy.get_waveforms()
+
+    ## Optionally, prolong the truncated records by harmonic inversion
+    headerstring = ""
+    if extrapolate and (frequency_domain or running_dft):
+        meep.master_printf("Warning\tThe extrapolation of waveforms is not possible with %s, it is not used\n" % 
+                ("frequency-domain simulation" if frequency_domain else "the running Fourier transform"))
+    elif extrapolate:
+        import harminv_wrapper
+        t_end = t[0] + (t[-1]-t[0])*(1+extrapolate)
+        extrapolated = map(lambda field: harminv_wrapper.harminv_extrapolate(t, field, t_end), (Ex1, Hy1, Ex2, Hy2))
+        if len(set([len(new_t) for (new_t, field, residual) in extrapolated])) > 1:
+            ## (some of the records, e.g. an all-zero one, could not be fitted; all of them must keep the same length)
+            meep.master_printf("Warning\tSome of the waveforms could not be fitted by oscillators, they are not extrapolated\n")
+        else:
+            (t, Ex1, res1), (t, Hy1, res2), (t, Ex2, res3), (t, Hy2, res4) = extrapolated
+            residual = max(res1, res2, res3, res4)
+            meep.master_printf("Info\tWaveforms extrapolated to %e s, relative residual of the oscillator fit %.2e\n" % (t_end, residual))
+            headerstring += "#param extrapolation_residual,%.3e\n" % residual
+
+    ## Hann-window fadeout to suppress spectral leakage (note the monitors return views of their data, which must not 
+    ## be modified in place)
+    if not frequency_domain and not running_dft:
+        window = np.ones_like(t)
+        window[t>max(t)*.8] = .5 + .5*np.cos(np.pi * (t[t>max(t)*.8]/max(t)-.8)/(1-.8))
+        (Ex1, Hy1, Ex2, Hy2) = map(lambda field: field*window, (Ex1, Hy1, Ex2, Hy2))
 
     try:
-        if diag:
-            import matplotlib
-            #matplotlib.use('Agg') ## Enable plotting even in the GNU screen session?
-            from matplotlib import pyplot as plt
+        if diag and not running_dft:
+            from meep_utils_plot import plt
             plt.figure(figsize=(7,6))
             plt.plot(t, abs(Ex1), label="Ex1")
             plt.plot(t, abs(Hy1), label="Hy1")
@@ -903,6 +1403,9 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
     if frequency_domain:            ## No need for FFT in frequency domain, just copy the value
         freq = np.array([frequency])
         (Ex1f, Hy1f, Ex2f, Hy2f) = (Ex1, Hy1, Ex2, Hy2)
+    elif running_dft:               ## The spectra were accumulated during the simulation, just truncate them
+        truncated = np.logical_and(np.logical_and((Ky**2+Kx**2)<((2*np.pi*freq/c)**2), freq>intf[0]), freq<intf[1])
+        (Ex1f, Hy1f, Ex2f, Hy2f, freq) = map(lambda x: x[truncated], (Ex1, Hy1, Ex2, Hy2, freq))
     else:
         if pad_zeros: 
             ## Extend the data range by zeros so that FFT is efficient; (artificially prolonging stable eff param retrieval)
@@ -918,7 +1421,7 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
         ## TODO Positive frequency range should be  separated just by truncation below, as 'minf => 0'
 
         #fftshift(x[, axes])	Shift the zero-frequency component to the center of the spectrum.
-        (Ex1f, Hy1f, Ex2f, Hy2f) = map(lambda x: np.fft.fft(np.real(x))[0:int(numpoints/2)], (Ex1, Hy1, Ex2, Hy2))
+        (Ex1f, Hy1f, Ex2f, Hy2f) = map(lambda x: np.fft.rfft(np.real(x))[0:int(numpoints/2)], (Ex1, Hy1, Ex2, Hy2))
         
         ## Truncate the data ranges to allowed radiating angles, and possibly to minf<freq<maxf
         truncated = np.logical_and(np.logical_and((Ky**2+Kx**2)<((2*np.pi*freq/c)**2), freq>intf[0]), freq<intf[1])
@@ -928,6 +1431,7 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
     ## Diagnostics: plot frequency-domain data
     try:
         if diag:
+            from meep_utils_plot import plt
             plt.figure(figsize=(7,6))
             plt.plot(freq, abs(Ex1f), label="Ex1")
             plt.plot(freq, abs(Hy1f), label="Hy1")
@@ -948,10 +1452,14 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
     ##    (Efield-Hfield)/2 ->    backward wave amplitude
     
     ## test: works for perp. incidence, and in any dielectric
-    Ex1f, Hy1f = Ex1f*(eps1**.25), Hy1f/(eps1**.25)
-    Ex2f, Hy2f = Ex2f*(eps2**.25), Hy2f/(eps2**.25)
-    in1, out1 =  (Ex1f+Hy1f)/2, (Ex1f-Hy1f)/2 ## old: works only for perp. incidence beta0=0
-    in2, out2 =  (Ex2f-Hy2f)/2, (Ex2f+Hy2f)/2
+    if ports:
+        in1, out1 = port1.separate_waves(Ex1f, Hy1f)
+        out2, in2 = port2.separate_waves(Ex2f, Hy2f)
+    else:
+        Ex1f, Hy1f = Ex1f*(eps1**.25), Hy1f/(eps1**.25)
+        Ex2f, Hy2f = Ex2f*(eps2**.25), Hy2f/(eps2**.25)
+        in1, out1 =  (Ex1f+Hy1f)/2, (Ex1f-Hy1f)/2 ## old: works only for perp. incidence beta0=0
+        in2, out2 =  (Ex2f-Hy2f)/2, (Ex2f+Hy2f)/2
 
     #beta0 = np.arcsin((Kx**2+Ky**2)**.5 / (2*np.pi*freq/c))
     #in1, out1 =  (Ex1f+Hy1f/np.cos(beta0))/2, (Ex1f-Hy1f/np.cos(beta0))/2 ## old: works only for monitors placed in vacuum
@@ -1005,7 +1513,7 @@ def get_s_parameters(monitor1_Ex, monitor1_Hy, monitor2_Ex, monitor2_Hy, #{{{
     if frequency_domain: meep.master_printf("Scattering parameters @ %.3e Hz: |s11|=%.3f, |s12|=%.3f\n" % (freq, np.abs(s11), np.abs(s12)))
 
     ## Return the S-parameters (i. e. complex reflection and transmission)
-    return freq, s11, s12, "#x-column freq\n#column |r|\n#column r phase\n#column |t|\n#column t phase\n"
+    return freq, s11, s12, headerstring+"#x-column freq\n#column |r|\n#column r phase\n#column |t|\n#column t phase\n"
 #}}}
 def get_phase(complex_data):#{{{
     """ Unwraps and shifts the phase from Fourier transformation """
@@ -1022,84 +1530,259 @@ class AmplitudeMonitorPlane(meep.Callback):#{{{
     A field averaging routine written in Python is used, which is very inefficient. 
 
     Note this implementation requires the planes are in vacuum (where impedance = 1.0)
+
+    If an array of frequencies `dft_freq' is given, the waveform is not stored, but its spectrum is accumulated 
+    by a running Fourier transform instead (see get_spectrum()). 
+
+    If a file name `stream' is given, the waveform is written to this file instead of memory (see WaveformStream 
+    in meep_utils_io); with `resume=True', an interrupted simulation continues writing to the existing file.
     """
 
 
-    def __init__(self, field, comp=None, size_x=None, size_y=None, resolution=None, z_position=None, Kx=0, Ky=0):
+    def __init__(self, field, comp=None, size_x=None, size_y=None, resolution=None, z_position=None, Kx=0, Ky=0, 
+            simtime=None, decimation=1, dft_freq=None, stream=None, resume=False):
         self.comp=comp
         self.size_x = size_x
         self.size_y = size_y
         self.z_position = z_position
         self.Kx = Kx
         self.Ky = Ky
+        self.init_storage(simtime, resolution, decimation, dft_freq, stream, resume)
 
-        self.t = []
-        self.waveform = []
+        ## If available, the whole plane is retrieved from MEEP in one call (newer versions of MEEP only; the plane 
+        ## is assumed to span the whole cell, as by default in SimulationRunner.add_monitor())
+        self.volume = meep.volume(meep.vec(-size_x/2, -size_y/2, z_position), meep.vec(size_x/2, size_y/2, z_position))
+        self.bulk_field = self.init_bulk_retrieval(field, resolution, 
+                (lattice_axis(size_x, resolution), lattice_axis(size_y, resolution), np.array([z_position])))
 
-        ## New way of averaging (removes explicit cycle, few percent faster)
+        ## Otherwise, the field is sampled in a grid of points (5x5 grid is usually optimal, no visible difference 
+        ## between 10x10 grid and 5x5 grid)
         xcount = min(5, int(np.ceil(size_x/resolution)))
         ycount = min(5, int(np.ceil(size_y/resolution)))
         print 'xcount, ycount' , xcount, ycount 
-        xr = [x0*self.size_x/xcount+(self.size_x/2/xcount)-self.size_x/2 for x0 in range(xcount)]
-        yr = [y0*self.size_y/ycount+(self.size_y/2/ycount)-self.size_y/2 for y0 in range(ycount)]
-
-        #for x in [x0*self.size_x/xcount+(self.size_x/2/xcount)-self.size_x/2 for x0 in range(xcount)]:
-            #for y in [y0*self.size_y/ycount+(self.size_y/2/ycount)-self.size_y/2 for y0 in range(ycount)]:
-                #field_sum += (field.get_field(self.comp, meep.vec(x, y, self.z_position)) *  
-                                #np.exp(1j*(self.Kx*x + self.Ky*y)) )
-        self.xm, self.ym = np.meshgrid(xr,yr)
-        self.xmm, self.ymm = self.xm.flatten(), self.ym.flatten()
-        self.points = zip(self.xmm, self.ymm)
-        self.vecs  = map(lambda pos: meep.vec(pos[0], pos[1], self.z_position), self.points)
-        self.phase = map(lambda pos: np.exp(1j*(self.Kx*pos[0] + self.Ky*pos[1])), self.points)
-        self.points = zip(self.vecs, self.phase)
-        if self.Kx == 0 and self.Ky == 0: 
-            self.fn = lambda point: field.get_field(self.comp, point[0])             ## just retrieve the fields
-        else:
-            self.fn = lambda point: field.get_field(self.comp, point[0])*point[1] ## account for the phase
+        self.vecs = [meep.vec(x, y, self.z_position) for (x, y) in zip(*self.get_grid(xcount, ycount))]
+        self.point_field = np.zeros(len(self.vecs), dtype=complex)       ## (preallocated buffer)
+        self.point_phase = self.get_phase_factors(xcount, ycount)
 
-    def average_field(self, field):
-        """
-        Average field component in some plane, return amplitudes 
-        This function is inefficient - it should be implemented in C++ in meep itself
+    def init_storage(self, simtime, resolution, decimation, dft_freq=None, stream=None, resume=False):
+        """ Preallocates the storage for the recorded waveform; if `simtime' is given, the number of time steps is known
+        in advance, otherwise (or if exceeded) the capacity is doubled when needed. 
 
-        5x5 grid is usually optimal (no visible difference between 10x10 grid and 5x5 grid)
+        If `decimation' > 1, only every n-th time step is recorded (see auto_decimation()). 
 
-        TODO:  This class implements a workaround for unavailable amplitude averaging in python-meep.
-        This implementation is inefficient and inflexible, but one would have to edit the MEEP source otherwise.
+        If `dft_freq' is given, only the spectrum at these frequencies is stored. If `stream' is given, the samples 
+        are written to this file. """
+        self.decimation = max(int(decimation), 1)
+        self.simtime = simtime
+        ## Monitors of multiple components (see MonitorPort) store one column per component
+        comps = getattr(self, 'comps', None)
+        if comps is None: 
+            self.magnetic, sample_shape = (meep.is_magnetic(self.comp) or meep.is_B(self.comp)), ()
+        else:
+            self.magnetic, sample_shape = np.array([meep.is_magnetic(comp) or meep.is_B(comp) for comp in comps]), (len(comps),)
+        self.dft_freq = None if dft_freq is None else np.asarray(dft_freq, dtype=float)
+        self.stream = None
+        if self.dft_freq is not None:
+            self.spectrum = np.zeros((len(self.dft_freq),)+sample_shape, dtype=complex)
+            capacity = 0
+        elif stream:
+            parameters = {'z_position':getattr(self, 'z_position', 0), 'Kx':self.Kx, 'Ky':self.Ky, 'decimation':self.decimation}
+            if hasattr(self, 'Kz'): parameters['Kz'] = self.Kz
+            if resolution: parameters['dt'] = meep.use_Courant()*resolution/c * self.decimation
+            for n, comp in enumerate(comps or (self.comp,)): parameters['comp%d' % n] = comp
+            self.stream = WaveformStream(stream, parameters, ncomp=(len(comps) if comps else None), resume=resume)
+            capacity = 0
+        elif simtime and resolution:
+            capacity = int(simtime / (meep.use_Courant()*resolution/c) / self.decimation) + 16
+        else:
+            capacity = 1024
+        self.t = np.zeros(capacity)
+        self.waveform = np.zeros((capacity,)+sample_shape, dtype=complex)
+        self.real_fields = False
+        self.count = 0
+        self.step = 0
+        self.pending = None
+        self.last_value = None
+
+    def get_grid(self, xcount, ycount):
+        """ Returns the x- and y-coordinates of the centers of the xcount*ycount rectangles covering the plane """
+        xr = (np.arange(xcount)+.5)*self.size_x/xcount - self.size_x/2
+        yr = (np.arange(ycount)+.5)*self.size_y/ycount - self.size_y/2
+        xm, ym = np.meshgrid(xr, yr, indexing='ij')
+        return xm.flatten(), ym.flatten()
+
+    def get_phase_factors(self, xcount, ycount):
+        """ The weights for averaging in the grid, including the phase factors for oblique incidence """
+        x, y = self.get_grid(xcount, ycount)
+        return np.exp(1j*(self.Kx*x + self.Ky*y)) / (xcount*ycount)
+
+    def init_bulk_retrieval(self, field, resolution, axes):
+        """ Prepares the retrieval of the field in `self.volume' by a single get_complex_array_slice() call.
+
+        MEEP returns the field interpolated to the points of its dielectric grid lying in the volume (including 
+        those on its faces; see lattice_axis()), the last non-empty axis changing fastest. The coordinates along each 
+        axis are given by `axes', whose lengths are checked against get_array_slice_dimensions(). The weights and 
+        the phase factors are then computed on these points, in the same order. The points on the opposite faces 
+        of the periodic cell are images of each other, so each of them gets half weight. 
+
+        Returns the preallocated buffer for the slice, or None if the bulk retrieval is not usable (the field is 
+        then sampled in points). """
+        if not (resolution and hasattr(field, 'get_complex_array_slice') and hasattr(field, 'get_array_slice_dimensions')):
+            return None
+        shape = [len(axis) for axis in axes if len(axis) > 1]
+        dims = np.zeros(3, dtype=np.intc)
+        try:
+            rank = field.get_array_slice_dimensions(self.volume, dims)
+        except (TypeError, ValueError, NotImplementedError), e:
+            meep.master_printf("Info\tBulk field retrieval not usable (%s), the field will be sampled in points\n" % e)
+            return None
+        if list(dims[:rank]) != shape:
+            meep.master_printf("Info\tMEEP array slice has %s points instead of %s, the field will be sampled in points\n" % 
+                    (list(dims[:rank]), shape))
+            return None
+        weights = []
+        for axis in axes:
+            weight = np.ones(len(axis))
+            if len(axis) > 1: weight[0] = weight[-1] = .5
+            weights.append(weight / np.sum(weight))
+        x, y, z = np.meshgrid(*axes, indexing='ij')
+        weight = np.einsum('i,j,k->ijk', *weights)
+        self.bulk_phase = (np.exp(1j*(self.Kx*x + self.Ky*y + getattr(self, 'Kz', 0)*z)) * weight).flatten()
+        return np.zeros(len(self.bulk_phase), dtype=complex)
+
+    def average_field(self, field, parallel=True):
         """
+        Average field component in some plane, return amplitudes 
 
-        return sum(map(self.fn, self.points))
-
-        #return sum(map(lambda vec: _meep.fields_get_field(field, self.comp, vec), self.vecs)) # takes the same time
+        The field is retrieved in a preallocated array, either by one bulk call to MEEP (see init_bulk_retrieval()), 
+        or point by point (as a workaround for older python-meep, which provides no bulk access). The average with 
+        the phase factors for oblique incidence is then computed as a single dot product.
 
-        ## todo for future? Should speed-up the integration!
-        ## def complex_vec(self, r): return 1. # <-- put above init
-        ## meep.Callback.__init__(self); meep.set_CMPL1_Callback(self.__disown__())     # <-- put to init
-        ## v = meep.volume( meep.vec(-self.size_x/2, -self.size_y/2, 0), meep.vec(self.size_x/2, self.size_y/2, 0))
-        ## import ctypes; return field.integrate(1, self.comp, self.complex_vec, ctypes.pointer(ctypes.c_int(0)), v)
+        With parallel=False, the points are sampled without any MPI communication, so that only the contribution 
+        of the points owned by this process is returned (the partial sums are to be summed by MonitorGroup).
+        """
+        if self.bulk_field is not None and parallel:
+            try:
+                field.get_complex_array_slice(self.volume, self.comp, self.bulk_field)
+                return np.dot(self.bulk_field, self.bulk_phase)
+            except (TypeError, ValueError, NotImplementedError), e:
+                meep.master_printf("Info\tBulk field retrieval not usable (%s), the field will be sampled in points\n" % e)
+                self.bulk_field = None
+
+        args = () if parallel else (False,)
+        for n, vec in enumerate(self.vecs):
+            self.point_field[n] = field.get_field(self.comp, vec, *args)
+        return np.dot(self.point_field, self.point_phase)
     
     def record(self, field=None):
         """ 
         Useful for time-domain simulation only
+
+        The field is retrieved in each `decimation'-th time step, and also in the next one, when the sample is stored.
+        The FDTD calculation introduces half-step time shift between Ex and Hy. Compensated by averaging the Hy field
+        with its value in a next timestep. The error is reduced from O1 to O2.
+        See http://ab-initio.mit.edu/wiki/index.php/Synchronizing_the_magnetic_and_electric_fields
+        The electric field is stored with the same delay, so that all monitors give the same number of samples.
         """
-        self.t.append(field.time()/c)
-        self.waveform.append(self.average_field(field))
+        self.push(field.time()/c, self.average_field(field) if self.sample_due() else None)
+
+    def use_real_fields(self):
+        """ Stores only the real part of the samples, if the fields are real (see SimulationRunner.run()); 
+        this halves the memory needed for the waveform """
+        self.real_fields = True
+        if self.count == 0: self.waveform = np.zeros(self.waveform.shape)
+
+    def use_symmetry(self, mirrors):
+        """ If the fields have mirror symmetries (see init_structure()), the points are sampled only in one 
+        symmetric part of the grid, and they are weighted to account for their mirror images. This reduces the 
+        number of get_field() calls up to four times. The array slice retrieved in bulk is already complete. """
+        comps = getattr(self, 'comps', None) or (self.comp,)
+        coords = np.array([[vec.x(), vec.y(), vec.z()] for vec in self.vecs])
+        tolerance = 1e-6 * max(self.size_x, self.size_y)
+        kept = np.ones(len(self.vecs), dtype=bool)
+        weights = np.ones((len(self.vecs), len(comps)))
+        for (direction, phase) in mirrors:
+            coord = coords[:, [meep.X, meep.Y, meep.Z].index(direction)]
+            kept &= (coord > -tolerance)
+            for m, comp in enumerate(comps):        ## (each point off the plane stands also for its image)
+                weights[coord > tolerance, m] *= 1 + mirror_parity(comp, direction, phase)
+        point_phase = np.reshape(self.point_phase, (len(self.vecs), -1))[kept] * weights[kept]
+        self.point_phase = point_phase if hasattr(self, 'comps') else point_phase[:,0]
+        self.vecs = [vec for (vec, keep) in zip(self.vecs, kept) if keep]
+        self.point_field = np.zeros((len(self.vecs),)+self.point_field.shape[1:], dtype=complex)
+
+    def sample_due(self):
+        """ Whether the field is to be sampled in the current time step """
+        return self.pending is not None or self.step % self.decimation == 0
+
+    def steps_to_due(self):
+        """ Number of time steps that can be skipped before the field is to be sampled """
+        return 0 if self.pending is not None else (-self.step) % self.decimation
+
+    def skip(self, steps):
+        """ Advances the decimation counter over `steps' time steps that were not recorded (see StepScheduler) """
+        self.step += steps
+
+    def push(self, t, value):
+        """ Processes the averaged field of the current time step (`value' is None if not sample_due()) """
+        due = (self.step % self.decimation == 0)
+        self.step += 1
+        if value is not None: 
+            if self.real_fields: value = np.real(value)
+            self.last_value = value
+        if self.pending is not None:            ## the previous time step was recorded, store it now
+            self.store(self.pending_t, np.where(self.magnetic, self.pending/2. + value/2., self.pending))
+            self.pending = None
+            if due: 
+                self.pending, self.pending_t = value, t
+        elif due:
+            self.pending, self.pending_t = value, t
+
+    def store(self, t, value):
+        if self.dft_freq is not None:
+            self.accumulate_spectrum(t, value)
+            return
+        if self.stream is not None:
+            self.stream.append(t, value)
+            self.count += 1
+            return
+        if self.count == len(self.t):       ## grow the storage geometrically
+            self.t = np.concatenate((self.t, np.zeros_like(self.t)))
+            self.waveform = np.concatenate((self.waveform, np.zeros_like(self.waveform)))
+        self.t[self.count] = t
+        self.waveform[self.count] = value
+        self.count += 1
+
+    def accumulate_spectrum(self, t, value):
+        """ Running discrete Fourier transform of the real part of the field; the result is equal to the FFT of the 
+        whole waveform (including the Hann-window fadeout at the end, and the time origin at the first sample), as 
+        computed in get_s_parameters(). """
+        if self.count == 0: 
+            self.t0 = t
+        if self.simtime and t > self.simtime*.8:
+            value = value * (.5 + .5*np.cos(np.pi * (min(t/self.simtime, 1)-.8)/(1-.8)))
+        self.spectrum += np.multiply.outer(np.exp(-2j*np.pi*self.dft_freq*(t-self.t0)), np.real(value))
+        self.count += 1
+
+    def get_spectrum(self):
+        """ Return the frequencies and the accumulated spectrum (if `dft_freq' was given)
+
+        In frequency domain, only one value is recorded, which is returned as is. """
+        if self.count == 0 and self.pending is not None:
+            return self.dft_freq, np.array([self.pending])
+        return self.dft_freq, self.spectrum
 
     def get_waveforms(self):
-        """ Return the recorded waveform (for time domain simulation only) """
-        if len(self.t) <= 1:
-            t, result_wform = np.array(self.t), np.array(self.waveform)
-        else:
-            t = np.array(self.t[:-1])
-            ## The FDTD calculation introduces half-step time shift between Ex and Hy. Compensated by averaging the Hy field
-            ## with its value in a next timestep. The error is reduced from O1 to O2.
-            ## See http://ab-initio.mit.edu/wiki/index.php/Synchronizing_the_magnetic_and_electric_fields
-            if meep.is_magnetic(self.comp) or meep.is_B(self.comp):
-                result_wform = np.array(self.waveform[:-1])/2. + np.array(self.waveform[1:])/2.
-            else: 
-                result_wform = np.array(self.waveform[:-1])
-            
+        """ Return the recorded waveform (for time domain simulation only) 
+
+        The returned arrays are views into the monitor storage, so they should not be modified in place. """
+        if self.count == 0 and self.pending is not None:        ## (one record only, e.g. in frequency domain)
+            return np.array([self.pending_t]), np.array([self.pending])
+        if self.stream is not None:                             ## (mapped from the file, loaded when accessed)
+            data = self.stream.get_data()
+            return data['t'], data['field']
+        t, result_wform = self.t[:self.count], self.waveform[:self.count]
+
         return t, result_wform 
          ## time, 
         ## TODO this will have to be modified in order to account for oblique incidence
@@ -1107,6 +1790,395 @@ class AmplitudeMonitorPlane(meep.Callback):#{{{
 #}}}
 
 
+class AmplitudeMonitorVolume(AmplitudeMonitorPlane):#{{{
+    """ Calculates an average of a field component in the whole simulation volume, with the phase factors 
+    given by the Kx, Ky and Kz wavevector components (used for the current-driven homogenisation, see cdh.py)
+
+    If available, the field in the whole volume is retrieved from MEEP in one call (see init_bulk_retrieval(); the 
+    volume is assumed to be the whole cell). Otherwise it is sampled in a grid of `samples' = (xcount, ycount, zcount) 
+    points. Recording and the decimation of samples are the same as for the planes.
+    """
+    def __init__(self, field, comp=None, size_x=None, size_y=None, size_z=None, resolution=None, Kx=0, Ky=0, Kz=0, 
+            simtime=None, decimation=1, dft_freq=None, stream=None, resume=False, samples=(1, 5, 3)):
+        self.comp=comp
+        self.size_x = size_x
+        self.size_y = size_y
+        self.size_z = size_z
+        self.Kx = Kx
+        self.Ky = Ky
+        self.Kz = Kz
+        self.init_storage(simtime, resolution, decimation, dft_freq, stream, resume)
+
+        self.volume = meep.volume(meep.vec(-size_x/2, -size_y/2, -size_z/2), meep.vec(size_x/2, size_y/2, size_z/2))
+        self.bulk_field = self.init_bulk_retrieval(field, resolution, (lattice_axis(size_x, resolution), 
+                lattice_axis(size_y, resolution), lattice_axis(size_z, resolution) if size_z else np.array([0.])))
+
+        self.vecs = [meep.vec(x, y, z) for (x, y, z) in zip(*self.get_grid(*samples))]
+        self.point_field = np.zeros(len(self.vecs), dtype=complex)
+        self.point_phase = self.get_phase_factors(*samples)
+
+    def get_grid(self, xcount, ycount, zcount):
+        """ Returns the coordinates of the centers of the xcount*ycount*zcount cuboids filling the volume """
+        xr = (np.arange(xcount)+.5)*self.size_x/xcount - self.size_x/2
+        yr = (np.arange(ycount)+.5)*self.size_y/ycount - self.size_y/2
+        zr = (np.arange(zcount)+.5)*self.size_z/zcount - self.size_z/2
+        xm, ym, zm = np.meshgrid(xr, yr, zr, indexing='ij')
+        return xm.flatten(), ym.flatten(), zm.flatten()
+
+    def get_phase_factors(self, xcount, ycount, zcount):
+        x, y, z = self.get_grid(xcount, ycount, zcount)
+        return np.exp(1j*(self.Kx*x + self.Ky*y + self.Kz*z)) / (xcount*ycount*zcount)
+#}}}
+class MonitorPort(AmplitudeMonitorPlane):#{{{
+    """ Records several field components in one plane (by default Ex and Hy, as needed for the S-parameters) 
+
+    All components are sampled in the same points in a single pass, and stored as one (steps x components) array. 
+    The port also separates the forward and backward waves (see separate_waves()), assuming the plane is placed in
+    a medium of permittivity `eps'. 
+
+    May be passed to get_s_parameters() instead of the pair of single-component monitors.
+    """
+    def __init__(self, field, comps=(meep.Ex, meep.Hy), size_x=None, size_y=None, resolution=None, z_position=None, 
+            Kx=0, Ky=0, simtime=None, decimation=1, dft_freq=None, stream=None, resume=False, eps=1):
+        self.comps = tuple(comps)
+        self.eps = eps
+        AmplitudeMonitorPlane.__init__(self, field, comp=None, size_x=size_x, size_y=size_y, resolution=resolution, 
+                z_position=z_position, Kx=Kx, Ky=Ky, simtime=simtime, decimation=decimation, dft_freq=dft_freq, 
+                stream=stream, resume=resume)
+        if self.bulk_field is not None:
+            self.bulk_field = np.zeros((len(self.comps), len(self.bulk_phase)), dtype=complex)
+        self.point_field = np.zeros((len(self.vecs), len(self.comps)), dtype=complex)
+        self.point_phase = np.outer(self.point_phase, np.ones(len(self.comps)))    ## (weights of each point and component)
+
+    def average_field(self, field, parallel=True):
+        """ Average all components in the plane, returns an array of amplitudes """
+        if self.bulk_field is not None and parallel:
+            try:
+                for n, comp in enumerate(self.comps):
+                    field.get_complex_array_slice(self.volume, comp, self.bulk_field[n])
+                return np.dot(self.bulk_field, self.bulk_phase)
+            except (TypeError, ValueError, NotImplementedError), e:
+                meep.master_printf("Info\tBulk field retrieval not usable (%s), the field will be sampled in points\n" % e)
+                self.bulk_field = None
+
+        args = () if parallel else (False,)
+        for n, vec in enumerate(self.vecs):
+            for m, comp in enumerate(self.comps):
+                self.point_field[n, m] = field.get_field(comp, vec, *args)
+        return np.sum(self.point_phase * self.point_field, axis=0)
+
+    def get_component(self, data, comp):
+        """ Selects one component from the data returned by get_waveforms() or get_spectrum() """
+        return data[..., self.comps.index(comp)]
+
+    def separate_waves(self, Ef, Hf):
+        """ Separates the waves travelling in the +z and -z direction in frequency domain 
+           (Efield+Hfield)/2 ->    forward wave amplitude, 
+           (Efield-Hfield)/2 ->    backward wave amplitude
+        test: works for perp. incidence, and in any dielectric """
+        Ef, Hf = Ef*(self.eps**.25), Hf/(self.eps**.25)
+        return (Ef+Hf)/2, (Ef-Hf)/2
+#}}}
+class MonitorGroup():#{{{
+    """ Records several monitors at once, with a single MPI reduction per time step
+
+    Each call of field.get_field() in MEEP is a collective operation, which makes the monitors the bottleneck of 
+    simulations on many processes. Here, each process samples the monitor points without communication (using 
+    get_field(comp, vec, False), i.e. only the points owned by the process contribute), and the partial averages of 
+    all monitors are summed at once by mpi4py. 
+
+    If this is not possible (single process, no mpi4py or mpi4py not sharing the MPI environment of meep_mpi, older 
+    MEEP without the `parallel' argument, or a monitor not sampling its field in points), the monitors are simply 
+    recorded one by one.
+    """
+    def __init__(self, field, monitors):
+        self.monitors = list(monitors)
+        self.comm = None
+        if getattr(meep, 'count_processors', lambda: 1)() > 1 and self.monitors:
+            try:
+                from mpi4py import MPI
+                if not MPI.Is_initialized() or MPI.COMM_WORLD.Get_size() != meep.count_processors() or \
+                        MPI.COMM_WORLD.Get_rank() != meep.my_rank():
+                    raise ValueError("mpi4py does not share the MPI environment with meep_mpi")
+                for monitor in self.monitors:       ## (test if MEEP supports it, with the own points and components)
+                    vecs = getattr(monitor, 'vecs', None)
+                    if not vecs: 
+                        raise ValueError("%s does not sample the field in points" % monitor.__class__.__name__)
+                    for comp in (getattr(monitor, 'comps', None) or (monitor.comp,)):
+                        field.get_field(comp, vecs[0], False)
+                self.comm, self.MPI = MPI.COMM_WORLD, MPI
+            except (ImportError, RuntimeError, AttributeError, TypeError, ValueError, NotImplementedError), e:
+                meep.master_printf("Info\tMonitors will be sampled by collective calls (%s)\n" % e)
+
+    def steps_to_due(self):
+        return min([monitor.steps_to_due() for monitor in self.monitors] or [np.inf])
+
+    def record(self, field=None, skipped=0):
+        """ Records the current time step; `skipped' time steps since the last call were not recorded """
+        if skipped: 
+            for monitor in self.monitors: monitor.skip(skipped)
+        if self.comm is None:
+            for monitor in self.monitors: monitor.record(field=field)
+            return
+        due = [monitor.sample_due() for monitor in self.monitors]
+        partial = [np.atleast_1d(monitor.average_field(field, parallel=False)) 
+                for (monitor, is_due) in zip(self.monitors, due) if is_due]
+        if partial:                     ## one reduction of all the partial sums (only real parts, if the fields are real)
+            if all([monitor.real_fields for monitor in self.monitors]):
+                buf = np.real(np.concatenate(partial)).astype(float)
+            else:
+                buf = np.concatenate(partial).astype(complex)
+            self.comm.Allreduce(self.MPI.IN_PLACE, buf, op=self.MPI.SUM)
+        t, index = field.time()/c, 0
+        for (monitor, is_due) in zip(self.monitors, due):
+            value = None
+            if is_due: 
+                size = np.size(monitor.magnetic)
+                value = buf[index:index+size] if np.ndim(monitor.magnetic) else buf[index]
+                index += size
+            monitor.push(t, value)
+#}}}
+def auto_decimation(model, safety_factor=4.):#{{{
+    """ Returns how many time steps can be skipped by the monitors, so that the sampling rate is `safety_factor' times 
+    higher than the Nyquist rate for the highest frequency of the model (the source, or the `interesting_frequencies'). 
+    The Courant-limited time step is usually much shorter than needed. """
+    f_max = max(getattr(model, 'interesting_frequencies', (0, 0))[1], model.src_freq + model.src_width)
+    dt = meep.use_Courant() * model.resolution / c
+    return max(int(1. / (2 * f_max * safety_factor * dt)), 1)
+#}}}
+def dft_frequencies(model, pad_zeros=1.0):#{{{
+    """ Returns the frequency grid for the monitors with running Fourier transform, with the same spacing as the FFT 
+    of the recorded waveform padded by zeros would have. Only the `interesting_frequencies' range is returned. """
+    intf = getattr(model, 'interesting_frequencies', [0, model.src_freq+model.src_width])
+    freq = np.arange(0., intf[1], 1./(model.simtime*(1+pad_zeros)))
+    return freq[freq>intf[0]]
+#}}}
+
+
+## === Running the simulation ===
+class SourceAmplitude(meep.Callback):#{{{
+    """ Spatial dependence of a source amplitude, given by a function of meep.vec (relative to the source center) """
+    def __init__(self, function): 
+        meep.Callback.__init__(self)
+        self.function = function
+    def complex_vec(self, vec):
+        return self.function(vec)
+#}}}
+class StepScheduler():#{{{
+    """
+    Performs the time stepping from one due event to the next one, instead of calling all the Python hooks 
+    (progress messages, monitors, slices) after every time step. 
+
+    Each hook is given by two functions: `due_step()' returns the number of the next time step at which 
+    `fire(now)' is to be called, and `fire(now)' may return True to end the simulation. Between the events, 
+    the fields are only stepped in a tight loop. The time steps are counted here, so that `now' is obtained 
+    without calling field.time().
+
+    The hooks still decide themselves whether to act (e.g. Slice.poll()), so that a rounding error of the due 
+    time may only result in one more call, never in a missed event.
+    """
+    def __init__(self, field, dt, simtime):
+        self.field, self.dt = field, dt
+        self.step = int(round(field.time()/c / dt))
+        self.end_step = int(np.ceil(simtime/dt - 1e-6))         ## (the last step when time reaches simtime)
+        self.hooks = []
+
+    def add_hook(self, due_step, fire):
+        self.hooks.append((due_step, fire))
+
+    def step_after(self, t):
+        """ The first time step after the time `t' [s] """
+        if t >= self.end_step*self.dt: return self.end_step + 1
+        return int(t/self.dt) + 1
+
+    def run(self):
+        """ Steps the fields until `simtime'; returns the time when a hook ended the simulation, or None """
+        field_step, hooks, dt = self.field.step, self.hooks, self.dt
+        while self.step < self.end_step:
+            due_steps = [due_step() for (due_step, fire) in hooks]
+            target = max(min(due_steps + [self.end_step]), self.step+1)
+            for i in xrange(target - self.step): field_step()
+            self.step, now = target, target*dt
+            for ((due_step, fire), due) in zip(hooks, due_steps):
+                if due <= target and fire(now): return now
+        return None
+#}}}
+class SimulationRunner():#{{{
+    """
+    Sets up and runs the simulation of a model, in time domain or in frequency domain (if the model has the 
+    `frequency' parameter). This is the common procedure of all the simulation scripts: the volume, the structure 
+    and the fields are created according to the model, and after the sources, monitors and slices are added, run() 
+    performs the time stepping until `simtime' (or until a stop criterion is met), or calls the frequency-domain solver.
+
+    The monitors are recorded together (see MonitorGroup). If the model has the `decay_dB' parameter, the simulation
+    ends once the field in the monitors decays (see DecayStopCriterion). The simulation is aborted with an error 
+    status if the monitored fields become numerically unstable, i.e. grow by `instability_dB' (40 dB by default, 
+    0 disables the check) after the source ended (see InstabilityWatchdog). Functions to be called in every time 
+    step can be added by add_step_function().
+
+    With `real_fields'='auto', the time-domain simulation uses real fields (half the memory and about half the 
+    computation time) if the Bloch vector is zero and all sources are real, i.e. no source was given a complex 
+    `amplitude' function. The monitors then record the real part of the field, which gives the same s-parameters. 
+    Scripts that need the complex fields themselves (e.g. the phase of a field record) should use real_fields=False.
+
+    If the `polarization' of a plane-wave source (e.g. meep.Ex) is given, the mirror symmetries declared by the model 
+    in `symmetry_planes' are used (unless broken by the materials, or by the Bloch vector), so that only a half or 
+    a quarter of the volume is computed. Only sources of this component, with uniform amplitude in a volume symmetric 
+    to these planes (such as plane_volume()), may be added then. MEEP reconstructs the fields in the whole volume 
+    for get_field() and for the slices; the monitors sample only the symmetric part of their grid. 
+
+    -- Example --
+    >>> runner = meep_utils.SimulationRunner(model, pml_axes=meep.Z, bloch=(meep.X, meep.Y))
+    >>> runner.add_source(meep.Ex, runner.plane_volume(-model.size_z/2+model.pml_thickness))
+    >>> port1 = runner.add_monitor(meep_utils.MonitorPort, z_position=model.monitor_z1)
+    >>> runner.add_slice(components=meep.Dielectric, at_t=0, name='EPS')
+    >>> runner.run()
+    """
+    def __init__(self, model, pml_axes=meep.Z, bloch=(meep.X, meep.Y), volume=None, real_fields='auto', polarization=None):
+        self.model = model
+        self.frequency_domain = bool(getattr(model, 'frequency', None))
+        if volume is None:
+            if getattr(model, 'size_z', 0): 
+                volume = meep.vol3d(model.size_x, model.size_y, model.size_z, 1./model.resolution)
+            else: 
+                volume = meep.vol2d(model.size_x, model.size_y, 1./model.resolution)
+            volume.center_origin()
+        self.volume = volume
+
+        ## The mirror symmetries declared by the model hold for the fields if the source is symmetric, too
+        self.polarization, mirrors = polarization, []
+        if polarization is not None:
+            for (axis, K) in zip((meep.X, meep.Y, meep.Z), ('Kx', 'Ky', 'Kz')):
+                if axis in getattr(model, 'symmetry_planes', ()) and not (axis in bloch and getattr(model, K, 0)):
+                    mirrors.append((axis, mirror_parity(polarization, axis, 1)))   ## (the source component is even)
+        self.structure = init_structure(model=model, volume=volume, pml_axes=pml_axes, mirrors=mirrors)
+        self.mirrors = model.mirrors
+        self.field = meep.fields(self.structure)
+        self.bloch = bloch
+        ## Define the Bloch-periodic boundaries (any transversal component of k-vector is allowed)
+        for axis, K in zip((meep.X, meep.Y, meep.Z), ('Kx', 'Ky', 'Kz')):
+            if axis in bloch: self.field.use_bloch(axis, getattr(model, K, 0) / (-2*np.pi))
+        self.real_fields, self.complex_sources = real_fields, False
+
+        self.monitors, self.slices, self.stop_criteria, self.step_functions = [], [], [], []
+        width = source_width(model)         ## (the gaussian source ends at 10/src_width; otherwise assume 10% of simtime)
+        self.source_end = 10./width if width else .1*getattr(model, 'simtime', 0)
+        self.stop_time = None
+
+    def source_time(self):
+        """ The default temporal shape of the source: gaussian pulse, or a continuous wave in frequency domain """
+        if self.frequency_domain: 
+            return meep.continuous_src_time(self.model.frequency/c)
+        return meep.gaussian_src_time(self.model.src_freq/c, self.model.src_width/c)
+
+    def plane_volume(self, z):
+        """ The whole x-y plane at `z' (e.g. for the plane wave source) """
+        return meep.volume(meep.vec(-self.model.size_x/2, -self.model.size_y/2, z), meep.vec(self.model.size_x/2, self.model.size_y/2, z))
+
+    def add_source(self, comp, volume, src_time=None, amplitude=None):
+        """ Adds a volume source of the field component `comp'; its `amplitude' may be given as a function of meep.vec """
+        if src_time is None: src_time = self.source_time()
+        if self.mirrors and (comp != self.polarization or amplitude is not None):
+            ## (the same condition holds on all processes, so all of them stop here)
+            raise ValueError("The source of component %s breaks the mirror symmetries of the simulation (see `polarization')" % comp)
+        if amplitude is not None:
+            self.complex_sources = True
+            meep.set_AMPL_Callback(SourceAmplitude(amplitude).__disown__())
+            self.field.add_volume_source(comp, src_time, volume, meep.AMPL)
+        else:
+            self.field.add_volume_source(comp, src_time, volume)
+
+    def add_monitor(self, monitor_class, **options):
+        """ Creates a monitor (e.g. AmplitudeMonitorPlane or MonitorPort); the options not given are taken from the model """
+        model = self.model
+        defaults = {'size_x':model.size_x, 'size_y':model.size_y, 'resolution':model.resolution, 
+                'Kx':getattr(model, 'Kx', 0), 'Ky':getattr(model, 'Ky', 0), 'simtime':model.simtime, 
+                'decimation':auto_decimation(model) if getattr(model, 'src_width', None) else 1,
+                'dft_freq':dft_frequencies(model) if getattr(model, 'running_dft', False) else None}
+        defaults.update(options)
+        monitor = monitor_class(self.field, **defaults)
+        if self.mirrors: monitor.use_symmetry(self.mirrors)
+        self.monitors.append(monitor)
+        return monitor
+
+    def add_slice(self, **options):
+        slice_ = Slice(model=self.model, field=self.field, **options)
+        self.slices.append(slice_)
+        return slice_
+
+    def add_step_function(self, function):
+        """ The `function(field, now)' will be called after each time step """
+        self.step_functions.append(function)
+
+    def run(self, check_stability=False, quit_on_warning=True):
+        model, field = self.model, self.field
+        if not self.frequency_domain:       ## time-domain computation
+            if self.use_real_fields(): 
+                meep.master_printf("Info\tNormal incidence and real sources, the fields are computed as real\n")
+                field.use_real_fields()
+                for monitor in self.monitors: monitor.use_real_fields()
+            field.step()
+            if check_stability: lorentzian_unstable_check_new(model, field.time()/c, quit_on_warning=quit_on_warning)
+            monitors = MonitorGroup(field, self.monitors)
+            watchdog = None
+            if getattr(model, 'instability_dB', 40.) and self.monitors:
+                watchdog = InstabilityWatchdog(model, self.monitors, growth_dB=getattr(model, 'instability_dB', 40.), 
+                        source_end=self.source_end)
+                self.stop_criteria.append(watchdog)
+            if getattr(model, 'decay_dB', None) and self.monitors:
+                width = source_width(model)
+                self.stop_criteria.append(DecayStopCriterion(model, self.monitors, model.decay_dB, source_end=self.source_end, 
+                        window=(2./width if width else .02*model.simtime)))
+            timer = Timer(simtime=model.simtime); meep.quiet(True) # use custom progress messages
+
+            ## Each hook is called only at the time steps when it is due (see StepScheduler)
+            scheduler = StepScheduler(field, dt=field.time()/c, simtime=model.simtime)
+            scheduler.add_hook(lambda: scheduler.step_after(timer.next_report()), timer.print_progress)
+            if self.monitors:
+                last_record = [scheduler.step]
+                def record_monitors(now):
+                    monitors.record(field=field, skipped=scheduler.step-last_record[0]-1)
+                    last_record[0] = scheduler.step
+                    return bool([criterion for criterion in self.stop_criteria if criterion.should_stop(now)])
+                scheduler.add_hook(lambda: last_record[0] + 1 + monitors.steps_to_due(), record_monitors)
+            for slice_ in self.slices: 
+                scheduler.add_hook(lambda slice_=slice_: scheduler.step_after(slice_.next_due()), slice_.poll)
+            if self.step_functions:
+                def call_step_functions(now):
+                    for function in self.step_functions: function(field, now)
+                scheduler.add_hook(lambda: scheduler.step+1, call_step_functions)
+
+            self.stop_time = scheduler.run()
+            if self.stop_time and not (watchdog and watchdog.unstable): 
+                model.parameterstring += "#param effective_simtime,%.3e\n" % self.stop_time
+            for slice_ in self.slices: slice_.finalize()
+            if watchdog and watchdog.unstable:      ## (the monitored values, and thus the decision, are the same on all processes)
+                meep.master_printf("Error: the simulation %s was aborted at %e s due to numerical instability\n" % 
+                        (model.simulation_name, self.stop_time))
+                meep.all_wait()
+                sys.exit(1)
+            notify(model.simulation_name, run_time=timer.get_time())
+        else:                               ## frequency-domain computation
+            field.solve_cw(getattr(model, 'MaxTol',0.001), getattr(model, 'MaxIter', 5000), getattr(model, 'BiCGStab', 8)) 
+            for monitor in self.monitors: monitor.record(field=field)
+            for slice_ in self.slices: slice_.finalize()
+            notify(model.simulation_name)
+
+    def use_real_fields(self):
+        """ Decides whether the fields can be real (see the `real_fields' parameter) """
+        if self.real_fields != 'auto': 
+            return bool(self.real_fields)
+        bloch_vector = [getattr(self.model, K, 0) for (axis, K) in zip((meep.X, meep.Y, meep.Z), ('Kx', 'Ky', 'Kz')) if axis in self.bloch]
+        return (not self.complex_sources) and (not np.any(bloch_vector)) and hasattr(self.field, 'use_real_fields')
+
+    def pad_zeros(self, pad_zeros=1.0):
+        """ Zero padding for get_s_parameters(); if the simulation ended early, the padding is extended to keep 
+        the frequency resolution given by `simtime' """
+        if self.stop_time: return (1+pad_zeros)*self.model.simtime/self.stop_time - 1
+        return pad_zeros
+#}}}
+
+
 ## === Experimental zone ===
 """ TODOs:#{{{
     * replace the classes of AmplitudeMonitorPlane and AmplitudeMonitorPoint 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#coding:utf8 
+"""
+Reading and writing of the text data files with the `#param' headers, as exported by the simulation scripts, 
+and of the binary waveform files streamed by the monitors. 
+
+This module does not depend on meep, so it can be used by the post-processing scripts as well. 
+Its functions are also accessible from `meep_utils'.
+"""
+import os
+import numpy as np
+
+def savetxt(fname, X, header, **kwargs):#{{{ 
+    """
+    Its use is for older versions of the library that do not accept the `header' parameter
+    """
+    #FIXME - This function will be superseded by numpy.savetxt
+    with open(fname, "w") as outfile: 
+        outfile.write(header)
+        np.savetxt(outfile, X, **kwargs)
+#}}}
+def loadtxt_params(filename): #{{{
+    parameters  = {}
+    with open(filename) as datafile:
+        for line in datafile:
+            if (line[0:1] in '0123456789') or ('column' in line.lower()): break    # end of parameter list
+            key, value = line.replace(',', ' ').split()[-2:]
+            try: value = float(value) ## Try to convert to float, if possible
+            except: pass                ## otherwise keep as string
+            parameters[key] = value
+    return parameters
+#}}}
+def loadtxt_columns(filename): #{{{
+    columns     = []
+    with open(filename) as datafile:
+        for line in datafile:
+            if ('column' in line.lower()): columns.append(line.strip().split(' ', 1)[-1]) # (todo) this may need fixing to avoid collision
+    return columns
+#}}}
+## Binary waveform files: a text header of fixed size (with the `#param' lines), followed by the records of time and
+## complex field amplitude(s). The file is written in chunks through a memory map, and can be loaded lazily.
+HEADER_SIZE = 4096
+
+def waveform_dtype(ncomp=None):#{{{
+    """ One record: the time, and one complex amplitude (or `ncomp' amplitudes of different components) """
+    if ncomp: return np.dtype([('t', '<f8'), ('field', '<c16', (int(ncomp),))])
+    return np.dtype([('t', '<f8'), ('field', '<c16')])
+#}}}
+def read_waveform_header(fname):#{{{
+    parameters = {}
+    with open(fname, 'rb') as datafile:
+        for line in datafile.read(HEADER_SIZE).splitlines():
+            if not line.startswith('#param'): continue
+            key, value = line.replace(',', ' ').split()[-2:]
+            try: value = float(value) ## Try to convert to float, if possible
+            except: pass                ## otherwise keep as string
+            parameters[key] = value
+    return parameters
+#}}}
+def load_waveform(fname):#{{{
+    """ Returns the parameters from the header, and a read-only memory map of the records (with the fields `t' and 
+    `field'), so that the data are loaded from the disk only when accessed.
+
+    If the writing was interrupted, the unused records at the end of the last chunk are skipped. """
+    parameters = read_waveform_header(fname)
+    dtype = waveform_dtype(parameters.get('ncomp'))
+    count = (os.path.getsize(fname) - HEADER_SIZE) // dtype.itemsize
+    if count <= 0: 
+        return parameters, np.zeros(0, dtype=dtype)
+    data = np.memmap(fname, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+    chunk = int(parameters.get('chunk', count))
+    unused = np.nonzero(np.isnan(data['t'][-chunk:]))[0]         ## (only the last chunk may be incomplete)
+    if len(unused): 
+        data = data[:count-min(chunk, count)+unused[0]]
+    return parameters, data
+#}}}
+class WaveformStream():#{{{
+    """ Writes the waveform samples to a binary file, so that the memory needed does not grow with the simulation 
+    time, and no data are lost if the simulation is killed. 
+
+    The `parameters' (e.g. the monitored component, position, time step, Kx, Ky) are written into the header. 
+    With `resume=True', the samples are appended to an existing file; the samples with time not later than the last 
+    stored one are skipped, so a restarted simulation continues writing where the interrupted one stopped. Note that 
+    MEEP does not store the fields, so the restarted simulation still computes them from t=0; only the already 
+    stored samples are not written again. The resumed file must have been written with the same `parameters' (e.g. 
+    the time step, decimation and the simulation parameters) and number of components, otherwise IOError is raised.
+    """
+    def __init__(self, fname, parameters={}, ncomp=None, chunk=4096, resume=False):
+        self.fname = fname
+        self.chunk = chunk
+        self.dtype = waveform_dtype(ncomp)
+        self.buffer = None
+        self.last_t = -np.inf
+        if resume and os.path.exists(fname):
+            old_parameters, data = load_waveform(fname)
+            if old_parameters.get('ncomp') != (float(ncomp) if ncomp else None):
+                raise IOError("Cannot resume writing to %s, it contains different number of components" % fname)
+            ## The values are compared as they would be read from the header (see read_waveform_header())
+            new_parameters = {}
+            for (key, value) in parameters.items():
+                try: new_parameters[key] = float("%s" % value)
+                except: new_parameters[key] = "%s" % value
+            mismatch = [key for key in sorted((set(new_parameters) | set(old_parameters)) - set(('ncomp', 'chunk')))
+                    if new_parameters.get(key) != old_parameters.get(key)]
+            if mismatch:
+                raise IOError("Cannot resume writing to %s, it was written with different parameters: %s" % 
+                        (fname, ", ".join(["%s (%s, now %s)" % (key, old_parameters.get(key), new_parameters.get(key)) 
+                            for key in mismatch])))
+            self.count = len(data)
+            if self.count: self.last_t = data['t'][-1]
+            del data
+            with open(fname, 'r+b') as datafile: datafile.truncate(HEADER_SIZE + self.count*self.dtype.itemsize)
+        else:
+            header = "".join(["#param %s,%s\n" % (key, value) for (key, value) in sorted(parameters.items())])
+            if ncomp: header += "#param ncomp,%d\n" % ncomp
+            header += "#param chunk,%d\n" % chunk
+            if len(header) >= HEADER_SIZE: 
+                raise ValueError("The header of %s is too long" % fname)
+            with open(fname, 'wb') as datafile: datafile.write(header.ljust(HEADER_SIZE-1) + "\n")
+            self.count = 0
+
+    def map_chunk(self):
+        """ Extends the file by one chunk, and maps it to the memory """
+        if self.buffer is not None: self.buffer.flush()
+        offset = HEADER_SIZE + self.count*self.dtype.itemsize
+        with open(self.fname, 'r+b') as datafile: datafile.truncate(offset + self.chunk*self.dtype.itemsize)
+        self.buffer = np.memmap(self.fname, dtype=self.dtype, mode='r+', offset=offset, shape=(self.chunk,))
+        self.buffer['t'] = np.nan           ## (marks the unused records)
+        self.index = 0
+
+    def append(self, t, value):
+        if t <= self.last_t: return         ## (already stored by the interrupted run)
+        if self.buffer is None or self.index == self.chunk: self.map_chunk()
+        self.buffer['t'][self.index] = t
+        self.buffer['field'][self.index] = value
+        self.index += 1
+        self.count += 1
+        self.last_t = t
+
+    def flush(self):
+        if self.buffer is not None: self.buffer.flush()
+
+    def close(self):
+        """ Writes the remaining data and removes the unused records """
+        if self.buffer is not None: 
+            self.buffer.flush()
+            self.buffer = None
+            with open(self.fname, 'r+b') as datafile: datafile.truncate(HEADER_SIZE + self.count*self.dtype.itemsize)
+
+    def get_data(self):
+        self.flush()
+        return load_waveform(self.fname)[1]
+#}}}
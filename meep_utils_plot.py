@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#coding:utf8 
+"""
+Plotting routines for the python-meep simulations, split off the `meep_utils' module so that matplotlib is 
+imported only when a plot is really made (and not on every MPI process at startup). 
+
+The functions are also accessible as meep_utils.plot_eps() etc., which import this module on demand.
+"""
+import numpy as np
+from scipy.constants import epsilon_0
+
+import matplotlib
+matplotlib.use('Agg') # may help against the "tkinter.TclError: bad screen distance" error
+import matplotlib.pyplot as plt
+
+import meep_mpi as meep
+from meep_utils import analytic_eps, permittivity2conductivity
+
+def annotate_frequency_axis(mark_freq, label_position_y=1, arrow_length=3, log_y=False):#{{{
+    """
+    """
+    if type(mark_freq) in (float,int): mark_freq=list(mark_freq,)
+    if type(mark_freq) in (list,tuple): mark_freq=dict(zip(mark_freq,['' for mf in mark_freq]))
+    for mfreq, mfreqtxt in mark_freq.items(): 
+        label_y2 = label_position_y
+        while (mfreqtxt[0:1]==' ' and mfreqtxt[-2:-1]==' '): 
+            label_y2 = label_y2*2 if log_y else label_y2+1
+            mfreqtxt=mfreqtxt[1:-1]; 
+        bboxprops   = dict(boxstyle='round, pad=.15', fc='white', alpha=1, lw=0)
+        arrowprops  = dict(arrowstyle=('->', '-|>', 'simple', 'fancy')[0], connectionstyle = 'arc3,rad=0', lw=1, ec='k', fc='w')
+        plt.annotate(mfreqtxt,                    
+                xy      = (mfreq, label_y2),    xycoords  ='data',
+                xytext  = (mfreq, label_y2*arrow_length if log_y else label_y+arrow_length),  textcoords='data',        # (delete this if text without arrow is used)
+                ha='center', va='bottom', size=15, color='k',
+                bbox        = bboxprops,        # comment out to disable bounding box
+                arrowprops  = arrowprops,       # comment out to disable arrow
+                )
+#}}}
+def plot_eps(*args, **kwargs):#{{{
+    try: plot_eps_(*args, **kwargs)
+    except: meep.master_printf("Could not plot the material permittivity spectra, probably matplotlib bug. Skipping it...")
+    #}}}
+def plot_eps_(to_plot, filename="epsilon.png", plot_conductivity=True, freq_range=(1e10, 1e18), mark_freq=[], draw_instability_area=None):#{{{
+    """ Plots complex permittivity of the materials to a PNG file
+
+    Accepts list of materials
+    """
+
+    #for material in list(to_plot): ## autoscale x axis?
+        #for pol in material.pol:
+            #if freq_range[1] < pol['omega']: freq_range[1] = pol['omega']*2
+
+    frequency = 10**np.arange(np.log10(freq_range[0]), np.log10(freq_range[1]), .01)
+
+    plt.figure(figsize=(7,6))
+    #colors = ['#000000', '#004400', '#003366', '#000088', '#440077', '#661100', 
+              #'#aa8800', '#00aa00', '#0099dd', '#0000EE', '#2200DD', '#aa0000']
+    colors = ['#000000', '#004400', '#003366', '#000088', '#440077', '#661100', 
+              '#aa8800', '#0044dd', '#00bb00', '#aaaa00', '#bb6600', '#dd0000']
+
+    subplotnumber = 2 if plot_conductivity else 1
+
+
+    for material in list(to_plot):
+        if colors: color = colors.pop()
+        else: color = 'black'
+        label = getattr(material, 'shortname', material.name)
+        plt.subplot(subplotnumber,1,1)
+
+        eps = np.conj(analytic_eps(material, frequency)) ## FIXME eps should be computed as conjugated by default
+
+        plt.subplot(subplotnumber,1,1)
+        plt.plot(frequency, np.real(eps), color=color, label=material.name, ls='-') #  
+        plt.plot(frequency, np.imag(eps), color=color, label='', ls='--') # 
+        #R = abs((1-eps**.5)/(1+eps**.5))**2     ## Intensity reflectivity
+
+        if plot_conductivity:
+            plt.subplot(subplotnumber,1,2)
+            label = ""
+            omega = 2*np.pi*frequency
+            cond = eps * omega * epsilon_0 * 1j ## for positive frequency convention
+            #cond = eps * omega * epsilon_0 / 1j ## for negative frequency convention
+
+            plt.plot(frequency, np.real(cond), color=color, label=material.name, ls='-')
+            plt.plot(frequency, np.imag(cond), color=color, label="#", ls='--')
+
+
+            #plt.plot(frequency, np.real(1./cond)*1e12, color=color, lw=1.5, label=("$\\rho^{'}\cdot 10^{12}$"), ls=':') ## (real) resistivity
+
+            # XXX temporary
+            #gamma = 1.5e+13
+            #f_p = 2.07153080589e+14
+            #omega_p =  1.3015811923e+15
+            #omega_p = 1.3015811923e+15 # / (2*np.pi)**.5
+
+            ## Low-frequency limits for pseudo-Drude model
+            #plt.plot(frequency, np.ones_like(omega) * omega_p**2 * epsilon_0 / gamma, color='k', label=label, ls='-', lw=.3)
+            #plt.plot(frequency, omega * (-epsilon_0 + omega_p**2 * epsilon_0 / gamma**2), color='k', label=label, ls='--', lw=.3)
+            ## High-frequency limits for pseudo-Drude model
+            #plt.plot(frequency, omega**-2 * (omega_p**2 * epsilon_0 * gamma), color='g', label=label, ls='-', lw=.3)
+            #plt.plot(frequency, omega * -epsilon_0            , color='g', label=label, ls='--', lw=.3)
+                                                    #^??????^/(2*np.pi)
+            # XXX                   #  ^^ ?????????? ^
+
+            ## TODO check this and perhaps remove:
+            #plt.subplot(subplotnumber,1,3)
+            #plt.plot(frequency, -np.real(cond), color=color, label=label, ls='-')
+            #plt.plot(frequency, -np.imag(cond), color=color, label="", ls='--')
+            #
+            #
+            #plt.ylabel(u"negative valued")
+            #plt.yscale('log'); 
+            #plt.xscale('log'); plt.legend(); plt.grid(True)
+
+
+
+    ## Annotate frequencies and finish the graph 
+    plt.subplot(subplotnumber,1,1)
+    plt.legend(prop={'size':8}, loc='lower right') 
+    plt.xlabel(u"frequency $f$ [Hz]") 
+    plt.ylabel(u"relative permittivity $\\varepsilon_r$")
+    plt.grid(True)
+    plt.xscale('log')
+    ylim = (-1e7, 1e6); plt.ylim(ylim); plt.yscale('symlog')
+    annotate_frequency_axis(mark_freq, log_y=True, arrow_length=50) # TODO , print_freq=True
+    if draw_instability_area:
+        plt.gca().add_patch(plt.Rectangle((draw_instability_area[0], ylim[0]), 1e20, draw_instability_area[1]-ylim[0], color='#bbbbbb'))
+
+    if plot_conductivity:
+        plt.subplot(subplotnumber,1,2)
+        plt.ylabel(u"conductivity $\\sigma$")
+        plt.xscale('log'); plt.grid(True)
+        plt.yscale('symlog'); plt.ylim((-1e12, 1e12)); 
+        plt.xlabel(u"frequency $f$ [Hz]") 
+
+    plt.xlabel(u"frequency $f$ [Hz]") 
+    plt.savefig(filename, bbox_inches='tight')
+#}}}
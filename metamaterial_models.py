@@ -31,7 +31,7 @@ import numpy as np
 from scipy.constants import c, epsilon_0, mu_0
 
 import meep_utils, meep_materials
-from meep_utils import in_sphere, in_xcyl, in_ycyl, in_zcyl, in_xslab, in_yslab, in_zslab, in_ellipsoid
+from meep_utils import Sphere, XCyl, YCyl, ZCyl, XSlab, YSlab, ZSlab, Repeat
 import meep_mpi as meep
 #import meep
 
@@ -50,10 +50,17 @@ class SphereWire(meep_utils.AbstractMeepModel): #{{{
         self.size_y = cellsize
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        ## Define the geometry
+        dd = self.resolution/4
+        self.where_sphere = self.where_geometry(
+                Repeat(Sphere(rad=radius, cx=dd, cy=dd, cz=dd), axis='z', pitch=cellsize, count=cellnumber))
+        self.where_wire = self.where_geometry(
+                Repeat(XCyl(rad=wirethick, cy=cellsize/2+dd) | XCyl(rad=wirethick, cy=-cellsize/2+dd), 
+                    axis='z', pitch=cellsize, count=cellnumber) - XSlab(d=wirecut, cx=dd))
+
         ## Define materials (with manual Lorentzian clipping) 
         self.materials = []  
         if radius > 0:
@@ -76,20 +83,6 @@ class SphereWire(meep_utils.AbstractMeepModel): #{{{
         meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         self.test_materials()
-
-    def where_sphere(self, r):
-        for cellc in self.cellcenters:
-            if  in_sphere(r, cx=self.resolution/4, cy=self.resolution/4, cz=cellc+self.resolution/4, rad=self.radius):
-                return self.return_value             # (do not change this line)
-        return 0
-    def where_wire(self, r):
-        for cellc in self.cellcenters:
-            if in_xslab(r, cx=self.resolution/4, d=self.wirecut):
-                return 0
-            if  in_xcyl(r, cy=self.size_y/2+self.resolution/4, cz=cellc, rad=self.wirethick) or \
-                    in_xcyl(r, cy= -self.size_y/2+self.resolution/4, cz=cellc, rad=self.wirethick):
-                return self.return_value             # (do not change this line)
-        return 0
 #}}}
 class RodArray(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=100e-12, resolution=4e-6, cellsize=100e-6, cellnumber=1, padding=20e-6, 
@@ -109,20 +102,16 @@ class RodArray(meep_utils.AbstractMeepModel): #{{{
         self.size_x, self.size_y  = self.resolution*2, cellsize
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         ## Define materials
+        self.where_TiO2 = self.where_geometry(XCyl(rad=radius))
+        self.symmetry_planes = (meep.X, meep.Y)     ## (allows to compute a quarter of the volume only)
+        #self.where_TiO2 = self.where_geometry(Sphere(rad=radius) - Sphere(rad=radius*.75))
         self.materials = [meep_materials.material_TiO2(where = self.where_TiO2)]  
         #self.materials = [meep_materials.material_dielectric(where = self.where_TiO2, eps=eps2)]  
 
         for m in self.materials: self.fix_material_stability(m)
         self.test_materials()
-
-    def where_TiO2(self, r):
-        #if  in_sphere(r, cx=0, cy=0, cz=0, rad=self.radius) and not  in_sphere(r, cx=0, cy=0, cz=0, rad=self.radius*.75):
-        if  in_xcyl(r, cy=0, cz=0, rad=self.radius):
-            return self.return_value             # (do not change this line)
-        return 0
 #}}}
 class Slab(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=100e-12, resolution=2e-6, cellnumber=1, cellsize=100e-6, padding=50e-6, 
@@ -139,10 +128,13 @@ class Slab(meep_utils.AbstractMeepModel): #{{{
         self.size_y = resolution
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        self.where_slab = self.where_geometry(
+                Repeat(ZSlab(d=cellsize*fillfraction), axis='z', pitch=cellsize, count=cellnumber))
+        self.symmetry_planes = (meep.X, meep.Y)     ## (allows to compute a quarter of the volume only)
+
         ## Define materials
         # note: for optical range, it was good to supply f_c=5e15 to fix_material_stability
         if 'Au' in comment:           
@@ -159,12 +151,6 @@ class Slab(meep_utils.AbstractMeepModel): #{{{
         #meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 #draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         #self.test_materials()
-
-    def where_slab(self, r):
-        for cellc in self.cellcenters:
-            if in_zslab(r, d=self.cellsize*self.fillfraction, cz=cellc):
-                return self.return_value             # (do not change this line)
-        return 0
 #}}}
 class ESRRArray(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=50e-12, resolution=4e-6, cellsize=100e-6, cellnumber=1, padding=20e-6, 
@@ -182,10 +168,29 @@ class ESRRArray(meep_utils.AbstractMeepModel): #{{{
         self.size_y = cellsize
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        ## Define the geometry of one cell
+        dd, R, t = self.resolution/4, radius, srrthick
+        wires = XCyl(rad=wirethick, cy=cellsize/2) | XCyl(rad=wirethick, cy=-cellsize/2)
+        ring = (YCyl(rad=R+t/2, cx=dd) & YSlab(d=t, cy=dd)) - YCyl(rad=R-t/2, cx=dd)
+        if splitting > 0:       # optional capacitor pads
+            ring = ring | (XCyl(rad=capacitorr, cy=dd, cz=R) & XSlab(d=splitting+2*t, cx=dd))
+        if splitting2 > 0:      # optional capacitor pads on second splitting
+            ring = ring | (XCyl(rad=capacitorr, cy=dd, cz=-R) & XSlab(d=splitting2+2*t, cx=dd))
+        ## the first splitting of SRR, and the 2nd splitting for symmetric SRR (the z-slabs reach beyond the cell)
+        ring = ring - (ZSlab(d=2*cellsize, cz=R/2+cellsize) & XSlab(d=splitting, cx=dd)) \
+                    - (ZSlab(d=2*cellsize, cz=-R/2-cellsize) & XSlab(d=splitting2, cx=dd))
+        cell = wires | ring
+        if cbarthick > 0:
+            cbar = YCyl(rad=R+t/2, cx=dd) & YSlab(d=t, cy=dd) & ZSlab(d=cbarthick)     # the central bar
+            if insplitting > 0:     # optional capacitor pads
+                cbar = cbar | (XCyl(rad=incapacitorr, cy=dd) & XSlab(d=insplitting+2*t, cx=dd))
+            ## splitting in the central bar for ESRR (the bar is completely disabled if insplitting high enough)
+            cell = cell | (cbar - (ZSlab(d=R) & XSlab(d=insplitting, cx=dd)))
+        self.where_wire = self.where_geometry(Repeat(cell, axis='z', pitch=cellsize, count=cellnumber))
+
         ## Define materials
         self.materials = []  
 
@@ -197,49 +202,6 @@ class ESRRArray(meep_utils.AbstractMeepModel): #{{{
         meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         self.test_materials()
-
-    def where_wire(self, r):
-        dd=self.resolution/4
-        for cellc in self.cellcenters:
-            ## define the wires
-            if  in_xcyl(r, cy=self.size_y/2, cz=cellc, rad=self.wirethick) or \
-                    in_xcyl(r, cy= -self.size_y/2, cz=cellc, rad=self.wirethick):
-                        return self.return_value             # (do not change this line)
-
-            if (    # define the first splitting of SRR
-                    not (r.z()>cellc+self.radius/2 and in_xslab(r, cx=dd, d=self.splitting))  
-                    # define the 2nd splitting for symmetric SRR
-                    and not (r.z()<cellc-self.radius/2 and in_xslab(r, cx=dd, d=self.splitting2))):
-                # make the ring (without the central bar)
-                if (in_ycyl(r, cx=dd, cz=cellc, rad=self.radius+self.srrthick/2)          # outer radius
-                        and in_yslab(r, cy=dd, d=self.srrthick)                             # delimit to a disc
-                        and not in_ycyl(r, cx=dd, cz=cellc, rad=self.radius-self.srrthick/2)):    # subtract inner radius 
-                    return self.return_value             # (do not change this line)
-                # optional capacitor pads
-                if (self.splitting > 0
-                        and in_xcyl(r, cy=dd, cz=cellc+self.radius, rad=self.capacitorr) 
-                        and in_xslab(r, cx=dd, d=self.splitting+2*self.srrthick)):          
-                    return self.return_value             # (do not change this line)
-                # optional capacitor pads on second splitting
-                if (self.splitting2 > 0 
-                        and in_xcyl(r, cy=dd, cz=cellc-self.radius, rad=self.capacitorr) 
-                        and in_xslab(r, cx=dd, d=self.splitting2+2*self.srrthick)):          
-                    return self.return_value             # (do not change this line)
-
-            if (self.cbarthick > 0 
-                    # def splitting in the central bar for ESRR (the bar is completely disabled if insplitting high enough)
-                    and not (in_zslab(r,cz=cellc,d=self.radius) and in_xslab(r, cx=dd, d=self.insplitting))):
-                if (in_ycyl(r, cx=dd, cz=cellc, rad=self.radius+self.srrthick/2)         # outer radius
-                        and in_yslab(r, cy=dd, d=self.srrthick)                          # delimit to a disc
-                        and in_zslab(r,cz=cellc,d=self.cbarthick)):                       # but allow the central bar
-                    return self.return_value             # (do not change this line)
-
-                if ((self.insplitting > 0)
-                        and in_xcyl(r, cy=dd, cz=cellc, rad=self.incapacitorr) 
-                        and in_xslab(r, cx=dd, d=self.insplitting+2*self.srrthick)):          # optional capacitor pads
-                    return self.return_value             # (do not change this line)
-
-        return 0
 #}}}
 class SphereInDiel(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=30e-12, resolution=4e-6, cellsize=100e-6, cellnumber=1, padding=50e-6, 
@@ -256,10 +218,18 @@ class SphereInDiel(meep_utils.AbstractMeepModel): #{{{
         self.size_y = cellsize
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        ## Define the geometry
+        dd = self.resolution/4
+        spheres = Repeat(Sphere(rad=radius, cx=dd, cy=dd, cz=dd), axis='z', pitch=cellsize, count=cellnumber)
+        self.where_sphere = self.where_geometry(spheres)
+        self.where_diel = self.where_geometry(ZSlab(d=cellsize) - spheres)
+        self.where_wire = self.where_geometry(
+                Repeat(XCyl(rad=wirethick, cy=cellsize/2+dd) | XCyl(rad=wirethick, cy=-cellsize/2+dd), 
+                    axis='z', pitch=cellsize, count=cellnumber) - XSlab(d=wirecut, cx=dd))
+
         ## Define materials (with manual Lorentzian clipping) 
         self.materials = []  
         if radius > 0:
@@ -284,28 +254,6 @@ class SphereInDiel(meep_utils.AbstractMeepModel): #{{{
         meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         self.test_materials()
-
-    def where_sphere(self, r):
-        for cellc in self.cellcenters:
-            if  in_sphere(r, cx=self.resolution/4, cy=self.resolution/4, cz=cellc+self.resolution/4, rad=self.radius):
-                return self.return_value             # (do not change this line)
-        return 0
-    def where_diel(self, r):
-        for cellc in self.cellcenters:
-            if in_sphere(r, cx=self.resolution/4, cy=self.resolution/4, cz=cellc+self.resolution/4, rad=self.radius):
-                return 0
-        for cellc in self.cellcenters:
-            if in_zslab(r, cz=0, d=self.cellsize):
-                return self.return_value             # (do not change this line)
-        return 0
-    def where_wire(self, r):
-        for cellc in self.cellcenters:
-            if in_xslab(r, cx=self.resolution/4, d=self.wirecut):
-                return 0
-            if  in_xcyl(r, cy=self.size_y/2+self.resolution/4, cz=cellc, rad=self.wirethick) or \
-                    in_xcyl(r, cy= -self.size_y/2+self.resolution/4, cz=cellc, rad=self.wirethick):
-                        return self.return_value             # (do not change this line)
-        return 0
 #}}}
 class Fishnet(meep_utils.AbstractMeepModel): #{{{       single-layer fishnet
     def __init__(self, comment="", simtime=150e-12, resolution=4e-6, cellsize=100e-6, cellnumber=1, padding=100e-6, 
@@ -326,10 +274,18 @@ class Fishnet(meep_utils.AbstractMeepModel): #{{{       single-layer fishnet
             self.size_y = cellsize
         self.size_z = cellnumber*cellsize + 4*padding + 2*self.pml_thickness
         self.monitor_z1, self.monitor_z2 = (-(cellsize*cellnumber/2)-padding, (cellsize*cellnumber/2)+padding)
-        self.cellcenters = np.arange((1-cellnumber)*cellsize/2, cellnumber*cellsize/2, cellsize)
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        ## Define the geometry: two metal layers with rounded rectangular holes
+        dd = self.resolution/4
+        xhr, yhr = xholesize/2-cornerradius, yholesize/2-cornerradius
+        holes = (XSlab(d=2*xhr, cx=dd) & YSlab(d=yholesize, cy=dd)) | (XSlab(d=xholesize, cx=dd) & YSlab(d=2*yhr, cy=dd)) | \
+                ZCyl(rad=cornerradius, cx=dd+xhr, cy=dd+yhr) | ZCyl(rad=cornerradius, cx=dd-xhr, cy=dd+yhr) | \
+                ZCyl(rad=cornerradius, cx=dd+xhr, cy=dd-yhr) | ZCyl(rad=cornerradius, cx=dd-xhr, cy=dd-yhr)
+        self.where_fishnet = self.where_geometry(
+                (ZSlab(d=slabthick, cz=-slabcdist/2) | ZSlab(d=slabthick, cz=+slabcdist/2)) - holes)
+
         ## Define materials (with manual Lorentzian clipping) 
         au = meep_materials.material_Au(where=self.where_fishnet)
         au.pol[0]['sigma'] /= 10      # adjust losses
@@ -341,22 +297,6 @@ class Fishnet(meep_utils.AbstractMeepModel): #{{{       single-layer fishnet
         meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         self.test_materials()
-
-    def where_fishnet(self, r):
-        dd=self.resolution/4
-        xhr, yhr = self.xholesize/2-self.cornerradius, self.yholesize/2-self.cornerradius
-        for cellc in self.cellcenters:
-            if (in_zslab(r, cz=-self.slabcdist/2, d=self.slabthick) or in_zslab(r, cz=+self.slabcdist/2, d=self.slabthick)):
-                if not (in_xslab(r, cx=dd, d=2*xhr) and \
-                        in_yslab(r, cy=dd, d=self.yholesize)) and \
-                        not (in_xslab(r, cx=dd, d=self.xholesize) and \
-                        in_yslab(r, cy=dd, d=2*yhr)) and \
-                        not in_zcyl(r, cx=dd+xhr, cy=dd+yhr, rad=self.cornerradius) and \
-                        not in_zcyl(r, cx=dd-xhr, cy=dd+yhr, rad=self.cornerradius) and \
-                        not in_zcyl(r, cx=dd+xhr, cy=dd-yhr, rad=self.cornerradius) and \
-                        not in_zcyl(r, cx=dd-xhr, cy=dd-yhr, rad=self.cornerradius):
-                            return self.return_value             # (do not change this line)
-        return 0
 #}}}
 class TMathieu_Grating(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=200e-15, resolution=20e-9, cellnumber=1, padding=50e-6, 
@@ -378,6 +318,10 @@ class TMathieu_Grating(meep_utils.AbstractMeepModel): #{{{
 
         self.register_locals(locals(), other_args)          ## Remember the parameters
 
+        ## Define the geometry: the first grid, and the second grid that may be transversally shifted
+        self.where_wire = self.where_geometry(XCyl(rad=rcore1, cz=-ldist/2) | 
+                XCyl(rad=rcore2, cy=tshift, cz=ldist/2) | XCyl(rad=rcore2, cy=tshift-tdist, cz=ldist/2))
+
         ## Define materials (with manual Lorentzian clipping) 
         self.materials = []  
 
@@ -389,16 +333,6 @@ class TMathieu_Grating(meep_utils.AbstractMeepModel): #{{{
         meep_utils.plot_eps(self.materials, plot_conductivity=True, 
                 draw_instability_area=(self.f_c(), 3*meep.use_Courant()**2), mark_freq={self.f_c():'$f_c$'})
         self.test_materials()
-
-    def where_wire(self, r):
-        if  in_xcyl(r, cy=0, cz=-self.ldist/2, rad=self.rcore1):                        ## first grid
-            return self.return_value             # (do not change this line)
-
-        if  in_xcyl(r, cy=self.tshift, cz=self.ldist/2, rad=self.rcore2) or \
-                in_xcyl(r, cy=self.tshift-self.size_y, cz=self.ldist/2, rad=self.rcore2):       ## second grid may be transversally shifted
-            return self.return_value             # (do not change this line)
-
-        return 0
 #}}}
 class HalfSpace(meep_utils.AbstractMeepModel): #{{{
     def __init__(self, comment="", simtime=100e-15, resolution=10e-9, cellnumber=1, padding=200e-9, cellsize = 200e-9,
@@ -429,6 +363,7 @@ class HalfSpace(meep_utils.AbstractMeepModel): #{{{
         self.monitor_z1, self.monitor_z2 = (-padding, padding)
         self.register_locals(locals(), other_args)          ## Remember the parameters
         self.mon2eps = epsilon                  ## store what dielectric is the second monitor embedded in
+        self.symmetry_planes = (meep.X, meep.Y)     ## (allows to compute a quarter of the volume only)
 
         ## Define materials
         self.materials = []  
@@ -441,6 +376,7 @@ class HalfSpace(meep_utils.AbstractMeepModel): #{{{
         else:                       self.materials += [meep_materials.material_dielectric(where=self.where_m, eps=self.epsilon)]
 
         for m in self.materials: 
+            m.where_array = self.where_m_array
             self.fix_material_stability(m, f_c=3e15) ## rm all osc above the first one, to optimize for speed 
 
         ## Test the validity of the model
@@ -463,6 +399,10 @@ class HalfSpace(meep_utils.AbstractMeepModel): #{{{
         #if r.z() > 0:
             #return self.return_value
         return 0
+    def where_m_array(self, x, y, z):
+        if self.blend == 0: 
+            return z >= 0
+        return np.clip((1.+np.sin(np.clip(z/0.5/self.blend, -1, 1)*np.pi/2))/2, 0, 1)
 #}}}
 
 models = {'default':Slab, 'Slab':Slab, 'SphereWire':SphereWire, 'RodArray':RodArray, 'SRRArray':ESRRArray, 'ESRRArray':ESRRArray, 'SphereInDiel':SphereInDiel, 'Fishnet':Fishnet,  'TMathieu_Grating':TMathieu_Grating, 'HalfSpace':HalfSpace}